@@ -6,14 +6,28 @@
 
 import os
 import sys
+import random
 import argparse
+import bisect
+import calendar
+import contextlib
+import copy
+import functools
+import json
+import math
+import re
 import socket
+import threading
 import time
+import uuid
+import Queue
+import urllib
 
 from urlparse import urlparse
 
 try:
-    from tsuruclient import client
+    import requests
+    from tsuruclient import base, client
 except:
     sys.stderr.write("This plugin requires tsuruclient module: https://pypi.python.org/pypi/tsuruclient\n")
     sys.exit(1)
@@ -43,118 +57,1097 @@ class RemoveNodeFromPoolError(Exception):
         return unicode(str(self))
 
 
-class TsuruPool(object):
+class ConstantBackoff(object):
+    """Waits the same interval between every attempt."""
 
-    def __init__(self, pool):
-        try:
-            self.tsuru_target = os.environ['TSURU_TARGET'].rstrip("/")
-            self.tsuru_token = os.environ['TSURU_TOKEN']
-            self.client = client.Client(self.tsuru_target, self.tsuru_token)
-        except KeyError:
-            raise KeyError("TSURU_TARGET or TSURU_TOKEN envs not set")
+    def __init__(self, interval):
+        self.interval = interval
+
+    def delays(self):
+        while True:
+            yield self.interval
+
+
+class ExponentialBackoff(object):
+    """Starts with short waits and doubles them, with jitter, up to interval.
+
+    Jitter keeps concurrent waiters from polling tsuru in lockstep.
+    """
+
+    def __init__(self, interval, initial=1, factor=2, jitter=0.2):
+        self.interval = interval
+        self.initial = initial
+        self.factor = factor
+        self.jitter = jitter
+
+    def delays(self):
+        delay = min(self.initial, self.interval)
+        while True:
+            yield random.uniform(delay * (1 - self.jitter), delay)
+            delay = min(delay * self.factor, self.interval)
+
+
+BACKOFF_POLICIES = {
+    "constant": ConstantBackoff,
+    "exponential": ExponentialBackoff,
+}
+
+
+class ScaledBackoff(object):
+    """Scales every delay of another backoff by factor."""
+
+    def __init__(self, backoff, factor):
+        self.backoff = backoff
+        self.factor = factor
+
+    def delays(self):
+        for delay in self.backoff.delays():
+            yield delay * self.factor
+
+
+class Deadline(object):
+
+    def __init__(self, seconds=None):
+        self.seconds = seconds
+        self.expires = None
+        if seconds is not None:
+            self.expires = time.time() + seconds
+
+    def remaining(self):
+        if self.expires is None:
+            return None
+        return max(0, self.expires - time.time())
+
+    def expired(self, delay=0):
+        remaining = self.remaining()
+        return remaining is not None and remaining <= delay
+
+
+class DeadlineExceeded(Exception):
+    def __init__(self, msg, seconds):
+        super(Exception, self).__init__(msg)
+        self.msg = msg
+        self.seconds = seconds
+
+    def __str__(self):
+        return '{} did not finish within {} seconds'.format(self.msg, self.seconds)
+
+    def __unicode__(self):
+        return unicode(str(self))
+
+
+def format_seconds(seconds, digits=1):
+    return '{:g}'.format(round(seconds, digits))
+
+
+class PendingEvent(object):
+
+    def __init__(self, msg, filters, max_retry=10, backoff=None,
+                 deadline=None, match=None):
+        self.msg = msg
+        self.filters = filters
+        self.match = match
+        self.max_retry = max_retry
+        self.failures = 0
+        self.delays = (backoff or ConstantBackoff(5)).delays()
+        self.deadline = deadline or Deadline()
+        self.next_poll = 0
+        self.event = None
+        self.error = None
+        self._done = threading.Event()
+
+    def schedule(self):
+        delay = next(self.delays)
+        self.next_poll = time.time() + delay
+        return delay
+
+    def poll_failed(self, ex):
+        if self.failures == self.max_retry:
+            sys.stderr.write("Failed to retrieve event.\n")
+            self.resolve(error=ex)
+            return
+        self.failures += 1
+
+    def resolve(self, event=None, error=None):
+        self.event = event
+        self.error = error
+        self._done.set()
+
+    @property
+    def done(self):
+        return self._done.is_set()
+
+    def result(self):
+        # waiting with a timeout keeps the main thread responsive to
+        # KeyboardInterrupt
+        while not self._done.wait(0.5):
+            pass
+        if self.error is not None:
+            raise self.error
+        return self.event
+
+
+class EventWatcher(object):
+    """Polls tsuru events on behalf of every operation waiting for one.
+
+    Each operation is polled on its own backoff schedule. Every tick issues
+    one events.list call per kind of event the due operations wait for,
+    narrowed to the filters they have in common, and routes the newest
+    matching event to each of them. An operation may also give a match predicate, for
+    event fields tsuru can not filter on. A newly registered operation is
+    polled right away.
+    """
+
+    # events.list filters and the event fields they select on
+    filter_fields = {
+        "kindname": ("Kind", "Name"),
+        "ownername": ("Owner", "Name"),
+        "target.type": ("Target", "Type"),
+        "target.value": ("Target", "Value"),
+    }
+
+    def __init__(self, client, backoff=None):
+        self.client = client
+        self.backoff = backoff or ExponentialBackoff(15)
+        self._pending = []
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def wait(self, msg, max_retry=10, deadline=None, match=None, **filters):
+        pending = PendingEvent(msg, filters, max_retry=max_retry,
+                               backoff=self.backoff, deadline=deadline, match=match)
+        with self._cond:
+            self._pending.append(pending)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+            self._cond.notify()
+        return pending.result()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                for p in self._pending:
+                    if not p.done and p.deadline.expired():
+                        p.resolve(error=DeadlineExceeded(p.msg, p.deadline.seconds))
+                self._pending = [p for p in self._pending if not p.done]
+                if not self._pending:
+                    self._thread = None
+                    return
+                now = time.time()
+                due = [p for p in self._pending if p.next_poll <= now]
+                if not due:
+                    wake_up = min(p.next_poll for p in self._pending)
+                    expires = [p.deadline.expires for p in self._pending
+                               if p.deadline.expires is not None]
+                    if expires:
+                        wake_up = min(wake_up, min(expires))
+                    self._cond.wait(max(0, wake_up - now))
+                    continue
+            self.tick(due)
+
+    @staticmethod
+    def common_filters(pending):
+        common = dict(pending[0].filters)
+        for p in pending[1:]:
+            for key, value in common.items():
+                if p.filters.get(key) != value:
+                    del common[key]
+        return common
+
+    def matches(self, event, filters):
+        for key, value in filters.items():
+            first, second = self.filter_fields[key]
+            if (event.get(first) or {}).get(second) != value:
+                return False
+        return True
+
+    def tick(self, pending):
+        # operations waiting for different kinds of events have no filter in
+        # common, and polling them together would list every event
+        groups = {}
+        for p in pending:
+            groups.setdefault(p.filters.get("kindname"), []).append(p)
+        for kind in sorted(groups, key=lambda kind: kind or ""):
+            self.poll(groups[kind])
+
+    def poll(self, pending):
+        query = self.common_filters(pending)
         try:
-            self.user = self.client.users.info()
+            events = self.client.events.list(**query)
         except Exception as ex:
-            raise Exception("Failed to get current user info: {}".format(ex))
-        self.pool = pool
+            sys.stderr.write("Failed to get event: {}. Retrying.\n".format(ex))
+            for p in pending:
+                p.poll_failed(ex)
+                p.schedule()
+            return
+        for p in pending:
+            remaining = dict((k, v) for k, v in p.filters.items() if k not in query)
+            try:
+                event = next(e for e in events if self.matches(e, remaining) and
+                             (p.match is None or p.match(e)))
+            except StopIteration:
+                p.poll_failed(IndexError("no {} event found".format(p.msg.lower())))
+                p.schedule()
+                continue
+            p.failures = 0
+            try:
+                running = event["Running"]
+                if event["Error"] != "":
+                    raise Exception(event["Error"])
+            except Exception as ex:
+                p.resolve(error=ex)
+                continue
+            if not running:
+                p.resolve(event=event)
+            else:
+                sys.stdout.write("{} still running. Checking again in {} seconds.\n"
+                                 .format(p.msg, format_seconds(p.schedule())))
 
-    def get_nodes(self):
+
+# node metadata tagging each node creation request, so its node.create
+# event can be told apart from concurrent ones
+REQUEST_ID_FIELD = "Metadata.pool-recycle-id"
+
+
+def started_with(name, value, event):
+    """Returns whether the request that started event had the form value
+    name=value. tsuru records request forms as the event StartCustomData."""
+    data = event.get("StartCustomData")
+    if not isinstance(data, list):
+        return False
+    return any(isinstance(item, dict) and item.get("name") == name and item.get("value") == value
+               for item in data)
+
+
+def run_concurrently(calls, size=None):
+    """Runs calls on up to size threads, one per call by default, and
+    waits for all of them.
+
+    Results and errors are dropped: calls are expected to cache what they
+    fetch, and to fail again when the result is actually used.
+    """
+    queue = Queue.Queue()
+    for call in calls:
+        queue.put(call)
+
+    def run():
+        while True:
+            try:
+                call = queue.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                call()
+            except Exception:
+                pass
+    threads = [threading.Thread(target=run) for _ in range(min(size or queue.qsize(), queue.qsize()))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+class ClusterSnapshot(object):
+    """Cluster wide listings of nodes, templates and healing configs.
+
+    Each listing is fetched once, indexed by pool and shared by every
+    TsuruPool using the snapshot. Listings older than ttl seconds, or
+    explicitly invalidated, are fetched again on next access. Node creation
+    times never change, so they are kept until the node leaves the node
+    listing.
+    """
+
+    def __init__(self, client, ttl=300):
+        self.client = client
+        self.ttl = ttl
+        self._created = {}
+        self._listings = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def _listing(self, name):
+        # one lock per listing, so different listings are fetched concurrently
+        with self._lock:
+            lock = self._locks.setdefault(name, threading.Lock())
+        with lock:
+            with self._lock:
+                entry = self._listings.get(name)
+            if entry is None or (self.ttl is not None and
+                                 time.time() - entry[0] > self.ttl):
+                entry = (time.time(), getattr(self, "_fetch_" + name)())
+                with self._lock:
+                    self._listings[name] = entry
+            return entry[1]
+
+    def prefetch(self, *names):
+        run_concurrently([functools.partial(self._listing, name) for name in names])
+
+    def invalidate(self, *names):
+        with self._lock:
+            for name in names or list(self._listings):
+                self._listings.pop(name, None)
+            if not names or "created" in names:
+                self._created.clear()
+
+    def _fetch_nodes(self):
         try:
             docker_nodes = self.client.nodes.list()
         except Exception as ex:
             raise Exception('Error get nodes from tsuru: "{}"'.format(ex))
+        index = {}
+        for node in docker_nodes.get('nodes') or []:
+            index.setdefault(node.get('Pool'), []).append(node)
+        addresses = set(node['Address'] for nodes in index.values() for node in nodes)
+        with self._lock:
+            for address in set(self._created) - addresses:
+                del self._created[address]
+        return index
 
-        pool_nodes = []
-        if 'nodes' in docker_nodes and docker_nodes['nodes'] is not None:
-            for node in docker_nodes['nodes']:
-                if (node.get('Pool') == self.pool):
-                    pool_nodes.append(node['Address'])
-        return pool_nodes
-
-    def create_new_node(self, iaas_template, curr_try=0, max_retry=10,
-                        retry_interval=60):
-        try:
-            data = {
-                "register": "false",
-                "Metadata.template": iaas_template
-            }
-            self.client.nodes.create(**data)
-            eventArgs = {
-                "ownername": self.user["Email"],
-                "kindname": "node.create",
-            }
-            event = self.wait_event("Node create", max_retry=max_retry, **eventArgs)
-        except Exception as ex:
-            if curr_try == max_retry:
-                raise NewNodeError("Maximum number of retries exceeded: {}"
-                                   .format(ex))
-            sys.stderr.write("Node creation failed: {}. Retrying in {} seconds\n"
-                             .format(ex, retry_interval))
-            time.sleep(retry_interval)
-            return self.create_new_node(iaas_template=iaas_template,
-                                        curr_try=curr_try+1,
-                                        max_retry=max_retry,
-                                        retry_interval=retry_interval)
-        return event["Target"]["Value"]
-
-    def get_machines_templates(self):
+    def _fetch_templates(self):
         try:
             machines_templates = self.client.templates.list()
         except Exception as ex:
             raise Exception('Error getting machines templates on tsuru: {}'
                             .format(ex))
-        iaas_templates = []
+        index = {}
         for template in machines_templates:
             for item in template['Data']:
-                if 'pool' == item['Name'] and self.pool == item['Value']:
-                    iaas_templates.append(template['Name'])
-        return iaas_templates
+                if 'pool' == item['Name']:
+                    index.setdefault(item['Value'], []).append(template)
+        return index
+
+    def _fetch_healings(self):
+        return self.client.healings.list()
+
+    def _node_events(self, kind):
+        try:
+            events = self.client.events.list(kindname=kind)
+        except Exception as ex:
+            raise Exception('Error getting {} events: {}'.format(kind, ex))
+        index = {}
+        for event in events or []:
+            if event.get("Running") or event.get("Error"):
+                continue
+            address = event["Target"]["Value"]
+            start = parse_time(event["StartTime"])
+            seconds = parse_time(event["EndTime"]) - start if event.get("EndTime") else None
+            if address not in index or index[address][0] < start:
+                index[address] = (start, seconds)
+        return index
+
+    def _fetch_creations(self):
+        # tsuru returns a single page of recent events: enough to time
+        # operations, not to date every node, see created()
+        return self._node_events("node.create")
+
+    def _fetch_removals(self):
+        return self._node_events("node.delete")
+
+    def nodes(self, pool):
+        return list(self._listing("nodes").get(pool, []))
+
+    def templates(self, pool):
+        return list(self._listing("templates").get(pool, []))
+
+    def healing(self, pool):
+        return self._listing("healings").get(pool)
+
+    def pools(self):
+        return sorted(self._listing("templates"))
+
+    def _fetch_created(self, node):
+        try:
+            events = self.client.events.list(**{"kindname": "node.create", "target.value": node})
+        except Exception as ex:
+            raise Exception('Error getting node.create events of node "{}": {}'.format(node, ex))
+        starts = [parse_time(event["StartTime"]) for event in events or []
+                  if not event.get("Running") and not event.get("Error")]
+        return max(starts) if starts else None
+
+    def created(self, node):
+        """Returns when the node's last node.create event started, or None
+        when tsuru keeps no such event for it."""
+        with self._lock:
+            if node in self._created:
+                return self._created[node]
+        created = self._fetch_created(node)
+        with self._lock:
+            self._created[node] = created
+        return created
+
+    def prefetch_created(self, nodes, size=None):
+        run_concurrently([functools.partial(self.created, node) for node in nodes],
+                         size=size or HTTP_POOL_SIZE)
+
+    def durations(self, kind):
+        """Returns how long the last successful "creations" or "removals"
+        event of each node took, by node address."""
+        return dict((address, seconds) for address, (_, seconds)
+                    in self._listing(kind).items() if seconds is not None)
+
+
+TIME_FORMAT = re.compile(r"(\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d)(\.\d+)?(Z|[+-]\d\d:\d\d)$")
+
+
+def parse_time(value):
+    """Returns the epoch of a RFC 3339 time, as used by tsuru events."""
+    match = TIME_FORMAT.match(value)
+    if match is None:
+        raise ValueError("invalid time: {}".format(value))
+    seconds = calendar.timegm(time.strptime(match.group(1), "%Y-%m-%dT%H:%M:%S"))
+    seconds += float(match.group(2) or 0)
+    if match.group(3) != "Z":
+        sign = -1 if match.group(3)[0] == "-" else 1
+        hours, minutes = match.group(3)[1:].split(":")
+        seconds -= sign * (int(hours) * 3600 + int(minutes) * 60)
+    return seconds
+
+
+DURATION_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400, "w": 604800}
+
+
+def parse_duration(value):
+    """Parses durations such as "90", "45m", "12h" or "7d" into seconds."""
+    unit = value[-1:].lower()
+    try:
+        if unit in DURATION_UNITS:
+            return float(value[:-1]) * DURATION_UNITS[unit]
+        return float(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid duration: {}".format(value))
 
-    def wait_event(self, msg, max_retry=10, **kwargs):
-        running = True
-        curr_try = 0
-        while running:
+
+def parse_window(value):
+    """Parses a daily UTC time window such as "22:00-06:00" into minutes
+    of the day it starts and ends at."""
+    try:
+        bounds = [time.strptime(bound, "%H:%M") for bound in value.split("-")]
+        start, end = [bound.tm_hour * 60 + bound.tm_min for bound in bounds]
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid window: {}".format(value))
+    return start, end
+
+
+def in_windows(windows, now=None):
+    """Returns whether now falls in any of the windows, or True without
+    windows. Windows ending before they start wrap around midnight."""
+    if not windows:
+        return True
+    moment = time.gmtime(now)
+    minute = moment.tm_hour * 60 + moment.tm_min
+    return any(start <= minute < end if start <= end else minute >= start or minute < end
+               for start, end in windows)
+
+
+def percentile(values, percent):
+    ordered = sorted(values)
+    if not ordered:
+        return 0
+    rank = int(math.ceil(percent / 100.0 * len(ordered))) - 1
+    return ordered[max(0, rank)]
+
+
+class RecycleMetrics(object):
+    """Durations of recycle phases and tsuru API calls, plus counters and
+    gauges.
+
+    Samples are grouped by family ("phase" or "api") and name, e.g.
+    ("phase", "create") or ("api", "nodes.remove"). With max_samples, only
+    that many recent samples are kept for each of them.
+    """
+
+    quantiles = [50, 90, 99]
+
+    def __init__(self, max_samples=None):
+        self.max_samples = max_samples
+        self.samples = {}
+        self.counters = {}
+        self.gauges = {}
+        self.started = time.time()
+        self._lock = threading.Lock()
+
+    def observe(self, family, name, seconds):
+        with self._lock:
+            samples = self.samples.setdefault((family, name), [])
+            samples.append((time.time(), seconds))
+            if self.max_samples is not None and len(samples) > self.max_samples:
+                del samples[0]
+
+    def set(self, family, name, value):
+        with self._lock:
+            self.gauges[(family, name)] = value
+
+    def increment(self, family, name, value=1):
+        with self._lock:
+            self.counters[(family, name)] = self.counters.get((family, name), 0) + value
+
+    def counter(self, family, name):
+        with self._lock:
+            return self.counters.get((family, name), 0)
+
+    @contextlib.contextmanager
+    def timer(self, family, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(family, name, time.time() - start)
+
+    def durations(self, family, name):
+        with self._lock:
+            return [seconds for _, seconds in self.samples.get((family, name), [])]
+
+    def _snapshot(self):
+        """Returns durations by (family, name), counters and gauges, copied
+        at once so they can be formatted while workers keep recording."""
+        with self._lock:
+            durations = dict((key, [seconds for _, seconds in values])
+                             for key, values in self.samples.items())
+            return durations, dict(self.counters), dict(self.gauges)
+
+    def summary(self):
+        lines = []
+        samples, counters, gauges = self._snapshot()
+        for (family, name), durations in sorted(samples.items()):
+            lines.append("  {:<6} {:<20} count={} {} max={} total={}".format(
+                family, name, len(durations),
+                " ".join("p{}={}".format(q, format_seconds(percentile(durations, q), 3))
+                         for q in self.quantiles),
+                format_seconds(max(durations), 3), format_seconds(sum(durations), 3)))
+        for (family, name), value in sorted(counters.items() + gauges.items()):
+            lines.append("  {:<6} {:<20} {}".format(family, name, value))
+        return lines
+
+    def write_json(self, path):
+        with self._lock:
+            samples = sorted((at, family, name, seconds)
+                             for (family, name), values in self.samples.items()
+                             for at, seconds in values)
+            counters = sorted(self.counters.items())
+            gauges = sorted(self.gauges.items())
+        with open(path, "w") as metrics_file:
+            for at, family, name, seconds in samples:
+                metrics_file.write(json.dumps({"time": at, family: name, "seconds": seconds}) + "\n")
+            for (family, name), value in counters:
+                metrics_file.write(json.dumps({"counter": name, "family": family,
+                                               "value": value}) + "\n")
+            for (family, name), value in gauges:
+                metrics_file.write(json.dumps({"gauge": name, "family": family,
+                                               "value": value}) + "\n")
+
+    def write_prometheus(self, path):
+        lines = []
+        samples, counters, gauges = self._snapshot()
+        for family in ["phase", "api"]:
+            metric = "pool_recycle_{}_duration_seconds".format(family)
+            names = sorted(name for fam, name in samples if fam == family)
+            if not names:
+                continue
+            lines.append("# TYPE {} summary".format(metric))
+            for name in names:
+                durations = samples[(family, name)]
+                for q in self.quantiles:
+                    lines.append('{}{{{}="{}",quantile="{}"}} {}'.format(
+                        metric, family, name, q / 100.0, percentile(durations, q)))
+                lines.append('{}_sum{{{}="{}"}} {}'.format(metric, family, name, sum(durations)))
+                lines.append('{}_count{{{}="{}"}} {}'.format(metric, family, name, len(durations)))
+        # one TYPE line per metric name, families of a name being its labels
+        for values, template, kind in [(counters, "pool_recycle_{}_total", "counter"),
+                                       (gauges, "pool_recycle_{}", "gauge")]:
+            for name in sorted(set(name for _, name in values)):
+                metric = template.format(name)
+                lines.append("# TYPE {} {}".format(metric, kind))
+                for family in sorted(fam for fam, other in values if other == name):
+                    lines.append('{}{{family="{}"}} {}'.format(metric, family,
+                                                               values[(family, name)]))
+        # textfile collectors may read at any time, so replace the file at once
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as metrics_file:
+            metrics_file.write("\n".join(lines) + "\n")
+        os.rename(tmp_path, path)
+
+    def write(self, path, metrics_format="json"):
+        if metrics_format == "prometheus":
+            self.write_prometheus(path)
+        else:
+            self.write_json(path)
+
+
+METRICS_FORMATS = ["json", "prometheus"]
+
+
+class InstrumentedManager(object):
+    """Times every call made through a tsuruclient manager."""
+
+    def __init__(self, name, manager, metrics):
+        self._name = name
+        self._manager = manager
+        self._metrics = metrics
+
+    def __getattr__(self, attr):
+        value = getattr(self._manager, attr)
+        if attr.startswith("_") or not callable(value):
+            return value
+
+        def call(*args, **kwargs):
+            with self._metrics.timer("api", "{}.{}".format(self._name, attr)):
+                return value(*args, **kwargs)
+        return call
+
+
+class TokenBucket(object):
+    """Allows rate requests per second on average, in bursts of up to
+    burst requests.
+
+    acquire() reserves a token and returns how long the caller must wait
+    for it, so waiting callers are served in the order they arrived.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = burst or max(1, self.rate)
+        self.tokens = self.burst
+        self.updated = time.time()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            now = time.time()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            return max(0, -self.tokens / self.rate)
+
+
+HTTP_POOL_SIZE = 10
+
+
+class SessionTransport(object):
+    """Sends the requests of every tsuruclient manager through one
+    keep-alive session.
+
+    tsuruclient opens a new connection, and a new TLS handshake, for each
+    request. The session keeps up to pool_size idle connections per host
+    and reuses them across managers and threads. Requests also wait on
+    the "read" (GET) or "write" token bucket of rate_limits, when set.
+    """
+
+    def __init__(self, pool_size=HTTP_POOL_SIZE, rate_limits=None, metrics=None):
+        self.rate_limits = rate_limits or {}
+        self.metrics = metrics or RecycleMetrics()
+        self.session = requests.Session()
+        self.adapter = None
+        self.pool_size = 0
+        self.grow(pool_size)
+
+    def grow(self, pool_size):
+        """Keeps up to pool_size idle connections per host from now on, when
+        that is more than before."""
+        if pool_size <= self.pool_size:
+            return
+        self.pool_size = pool_size
+        if self.adapter is not None:
+            self.adapter.close()
+        self.adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size,
+                                                     pool_maxsize=pool_size)
+        self.session.mount("http://", self.adapter)
+        self.session.mount("https://", self.adapter)
+
+    def install(self, tsuru_client):
+        for manager in vars(tsuru_client).values():
+            manager.request = self._bind(manager)
+        return tsuru_client
+
+    def _bind(self, manager):
+        def request(*args, **kwargs):
+            return self.request(manager, *args, **kwargs)
+        return request
+
+    def throttle(self, method):
+        kind = "read" if method.lower() == "get" else "write"
+        bucket = self.rate_limits.get(kind)
+        if bucket is None:
+            return
+        delay = bucket.acquire()
+        if delay > 0:
+            self.metrics.increment(kind, "rate_limited")
+            with self.metrics.timer("phase", "rate_limit"):
+                time.sleep(delay)
+
+    def send(self, manager, method, path, **kwargs):
+        return self.session.request(method, "{}{}".format(manager.target, path), **kwargs)
+
+    def close(self):
+        self.session.close()
+
+    def request(self, manager, method, path, version=None, handle_response=None, **kwargs):
+        self.throttle(method)
+        if version is not None:
+            path = "/{}{}".format(version, path)
+        kwargs["headers"] = manager.headers
+        response = self.send(manager, method, path, **kwargs)
+        if handle_response is not None:
+            return handle_response(response)
+        try:
+            response.raise_for_status()
+        except requests.exceptions.HTTPError as error:
+            raise base.TsuruAPIError("{}: {}".format(error, error.response.text))
+        if response.headers.get("content-type") == "application/x-json-stream":
+            return manager.json_stream(response)
+        return manager.json(response)
+
+
+def trace_key(method, path, params=None, data=None):
+    """Identifies a request in a trace. Node creation request ids are left
+    out: they are random, and told apart by order instead."""
+    def items(values):
+        return sorted((name, unicode(value)) for name, value in (values or {}).items()
+                      if name != REQUEST_ID_FIELD)
+    return json.dumps([method.upper(), path, items(params), items(data)])
+
+
+class RecordingTransport(SessionTransport):
+    """Session transport that also writes every request, its response and
+    how long it took to a trace file, one JSON object per line."""
+
+    def __init__(self, path, pool_size=HTTP_POOL_SIZE, rate_limits=None, metrics=None):
+        super(RecordingTransport, self).__init__(pool_size, rate_limits=rate_limits,
+                                                 metrics=metrics)
+        self.trace = open(path, "w")
+        self.started = time.time()
+        self._lock = threading.Lock()
+
+    def send(self, manager, method, path, **kwargs):
+        entry = {"at": time.time() - self.started, "method": method.upper(), "path": path,
+                 "params": kwargs.get("params") or {}, "data": kwargs.get("data") or {}}
+        start = time.time()
+        try:
+            response = super(RecordingTransport, self).send(manager, method, path, **kwargs)
+            # streamed bodies are read now, so they can be replayed
+            entry.update(status=response.status_code, body=response.text,
+                         type=response.headers.get("content-type"))
+            return response
+        except Exception as ex:
+            entry["error"] = str(ex)
+            raise
+        finally:
+            entry["seconds"] = round(time.time() - start, 6)
+            with self._lock:
+                self.trace.write(json.dumps(entry, separators=(",", ":")) + "\n")
+                self.trace.flush()
+
+    def close(self):
+        super(RecordingTransport, self).close()
+        with self._lock:
+            self.trace.close()
+
+
+class ReplayTransport(SessionTransport):
+    """Answers requests from a trace written by RecordingTransport, without
+    reaching tsuru.
+
+    Recorded responses to the same request are given back in order, the
+    last one over and over once they run out. Each answer takes the
+    recorded time divided by speed; a speed of 0 answers at once. Node
+    creation request ids of the trace are swapped for the ones of the
+    replayed run, in every later response.
+    """
+
+    def __init__(self, path, speed=1, metrics=None):
+        super(ReplayTransport, self).__init__(metrics=metrics)
+        self.scale = 1.0 / speed if speed else 0
+        self.responses = {}
+        self.aliases = {}
+        self._lock = threading.Lock()
+        with open(path) as trace:
+            for line in trace:
+                entry = json.loads(line)
+                key = trace_key(entry["method"], entry["path"], entry["params"], entry["data"])
+                self.responses.setdefault(key, []).append(entry)
+
+    def send(self, manager, method, path, **kwargs):
+        key = trace_key(method, path, kwargs.get("params"), kwargs.get("data"))
+        with self._lock:
+            entries = self.responses.get(key)
+            if not entries:
+                raise requests.exceptions.ConnectionError(
+                    "No recorded response for {} {}".format(method.upper(), path))
+            entry = entries.pop(0) if len(entries) > 1 else entries[0]
+            request_id = (kwargs.get("data") or {}).get(REQUEST_ID_FIELD)
+            if request_id is not None:
+                self.aliases[entry["data"].get(REQUEST_ID_FIELD)] = request_id
+            aliases = dict(self.aliases)
+        time.sleep(entry["seconds"] * self.scale)
+        if "error" in entry:
+            raise requests.exceptions.ConnectionError(entry["error"])
+        body = entry["body"]
+        for recorded, replayed in aliases.items():
+            if recorded:
+                body = body.replace(recorded, replayed)
+        response = requests.Response()
+        response.status_code = entry["status"]
+        response.headers["content-type"] = entry["type"]
+        response.url = "{}{}".format(manager.target, path)
+        response.encoding = "utf-8"
+        response._content = body.encode("utf-8")
+        return response
+
+
+def instrument_client(tsuru_client, metrics):
+    for name, manager in vars(tsuru_client).items():
+        setattr(tsuru_client, name, InstrumentedManager(name, manager, metrics))
+    return tsuru_client
+
+
+def timed(phase):
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            with self.metrics.timer("phase", phase):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class TsuruPool(object):
+
+    def __init__(self, pool, backoff="exponential", deadline=None,
+                 snapshot=None, metrics=None, http_pool_size=HTTP_POOL_SIZE,
+                 read_rate=None, write_rate=None, breaker_threshold=3,
+                 breaker_cooldown=300, record=None, replay=None, replay_speed=1):
+        self.metrics = metrics or RecycleMetrics()
+        rate_limits = {}
+        if read_rate:
+            rate_limits["read"] = TokenBucket(read_rate)
+        if write_rate:
+            rate_limits["write"] = TokenBucket(write_rate)
+        environ = os.environ
+        if replay is not None:
+            self.transport = ReplayTransport(replay, speed=replay_speed, metrics=self.metrics)
+            # replays never reach tsuru
+            environ = dict({"TSURU_TARGET": "http://tsuru", "TSURU_TOKEN": ""}, **os.environ)
+        elif record is not None:
+            self.transport = RecordingTransport(record, http_pool_size, rate_limits=rate_limits,
+                                                metrics=self.metrics)
+        else:
+            self.transport = SessionTransport(http_pool_size, rate_limits=rate_limits,
+                                              metrics=self.metrics)
+        try:
+            self.tsuru_target = environ['TSURU_TARGET'].rstrip("/")
+            self.tsuru_token = environ['TSURU_TOKEN']
+            tsuru_client = self.transport.install(client.Client(self.tsuru_target, self.tsuru_token))
+            self.client = instrument_client(tsuru_client, self.metrics)
+        except KeyError:
+            raise KeyError("TSURU_TARGET or TSURU_TOKEN envs not set")
+        # fetched on first use and shared with handlers from for_pool
+        self._user = {}
+        self._user_lock = threading.Lock()
+        self.pool = pool
+        self.backoff = BACKOFF_POLICIES[backoff]
+        if replay is not None and replay_speed != 1:
+            # waits between polls and retries follow the replay speed
+            policy, factor = self.backoff, 1.0 / replay_speed if replay_speed else 0
+            self.backoff = lambda interval: ScaledBackoff(policy(interval), factor)
+        self.deadline = deadline
+        self.event_watcher = EventWatcher(self.client, backoff=self.backoff(15))
+        self.snapshot = snapshot or ClusterSnapshot(self.client)
+        self.template_health = TemplateHealth(breaker_threshold, breaker_cooldown)
+
+    def close(self):
+        """Closes API connections, and the trace file of a recorded run."""
+        self.transport.close()
+
+    def grow_http_pool(self, pool_size):
+        self.transport.grow(pool_size)
+
+    def for_pool(self, pool):
+        """Returns a handler for another pool sharing this handler's client,
+        user, event watcher and cluster snapshot."""
+        handler = copy.copy(self)
+        handler.pool = pool
+        return handler
+
+    @property
+    def user(self):
+        with self._user_lock:
+            if not self._user:
+                try:
+                    self._user.update(self.client.users.info())
+                except Exception as ex:
+                    raise Exception("Failed to get current user info: {}".format(ex))
+            return self._user
+
+    def prefetch(self, listings, user=False):
+        """Fetches cluster listings, and the current user, all at once."""
+        calls = [functools.partial(self.snapshot.prefetch, *listings)]
+        if user:
+            calls.append(lambda: self.user)
+        run_concurrently(calls)
+
+    def get_nodes(self):
+        return [node['Address'] for node in self.snapshot.nodes(self.pool)]
+
+    def get_node_templates(self):
+        return dict((node['Address'], (node.get('Metadata') or {}).get('template'))
+                    for node in self.snapshot.nodes(self.pool))
+
+    def retry_sleep(self, phase, delay):
+        self.metrics.increment(phase, "retries")
+        with self.metrics.timer("phase", "retry_sleep"):
+            time.sleep(delay)
+
+    @timed("create")
+    def create_new_node(self, iaas_template, curr_try=0, max_retry=10,
+                        retry_interval=60, planner=None, on_failover=None):
+        """Creates a node from iaas_template and returns its address.
+
+        With a planner, a template whose circuit breaker opens is swapped
+        at once for another healthy one, and on_failover is called with it.
+        When no other template is healthy, the creation keeps retrying on
+        its template with the usual backoff.
+        """
+        deadline = Deadline(self.deadline)
+        delays = self.backoff(retry_interval).delays()
+        while True:
+            self.template_health.attempt(iaas_template)
+            request_id = uuid.uuid4().hex
             try:
-                event = self.client.events.list(**kwargs)[0]
-            except Exception, ex:
+                data = {
+                    "register": "false",
+                    "Metadata.template": iaas_template,
+                    REQUEST_ID_FIELD: request_id,
+                }
+                self.client.nodes.create(**data)
+                eventArgs = {
+                    "ownername": self.user["Email"],
+                    "kindname": "node.create",
+                }
+                event = self.wait_event("Node create", max_retry=max_retry,
+                                        deadline=deadline,
+                                        match=functools.partial(started_with, REQUEST_ID_FIELD, request_id),
+                                        **eventArgs)
+                self.snapshot.invalidate("nodes")
+                self.template_health.succeeded(iaas_template)
+                return event["Target"]["Value"]
+            except Exception as ex:
+                if self.template_health.failed(iaas_template):
+                    self.metrics.increment("create", "breaker_opens")
+                    sys.stderr.write('Template "{}" circuit breaker opened: {}\n'
+                                     .format(iaas_template, ex))
                 if curr_try == max_retry:
-                    sys.stderr.write("Failed to retrieve event.")
-                    raise ex
-                curr_try = curr_try + 1
-                sys.stderr.write("Failed to get event. Retrying in 15 seconds.")
-                time.sleep(15)
-                continue
-            curr_try = 0
-            running = event["Running"]
-            if event["Error"] != "":
-                raise Exception(event["Error"])
-            if running:
-                sys.stdout.write("{} still running. Sleeping for 15 seconds.\n"
-                                 .format(msg))
-                time.sleep(15)
-        return event
+                    raise NewNodeError("Maximum number of retries exceeded: {}"
+                                       .format(ex))
+                if planner is not None and not self.template_health.is_healthy(iaas_template):
+                    # with every template failing, this one keeps being retried
+                    template = planner.reassign(iaas_template)
+                    if template != iaas_template:
+                        sys.stderr.write('Failing over from template "{}" to "{}"\n'
+                                         .format(iaas_template, template))
+                        self.metrics.increment("create", "failovers")
+                        iaas_template = template
+                        if on_failover is not None:
+                            on_failover(template)
+                        curr_try += 1
+                        continue
+                delay = next(delays)
+                if deadline.expired(delay):
+                    raise NewNodeError("Deadline exceeded: {}".format(ex))
+                sys.stderr.write("Node creation failed: {}. Retrying in {} seconds\n"
+                                 .format(ex, format_seconds(delay)))
+                self.retry_sleep("create", delay)
+                curr_try += 1
 
+    def get_machines_templates(self):
+        return [template['Name'] for template in self.snapshot.templates(self.pool)]
+
+    def get_node_ages(self):
+        """Returns seconds since each node's node.create event, or None
+        for nodes created before the oldest event tsuru keeps."""
+        nodes = self.get_nodes()
+        # one query per node: a cluster-wide listing only covers recent events
+        self.snapshot.prefetch_created(nodes)
+        now = time.time()
+        ages = {}
+        for node in nodes:
+            created = self.snapshot.created(node)
+            ages[node] = None if created is None else now - created
+        return ages
+
+    def get_operation_durations(self):
+        """Returns past node creation times by template of this pool, over
+        every template, and past node removal times."""
+        creations = self.snapshot.durations("creations")
+        templates = self.get_node_templates()
+        by_template = {}
+        for node, seconds in creations.items():
+            if templates.get(node) is not None:
+                by_template.setdefault(templates[node], []).append(seconds)
+        return by_template, creations.values(), self.snapshot.durations("removals").values()
+
+    def get_template_drift(self):
+        """Returns, for each node no longer matching its pool's templates,
+        why it does not."""
+        templates = dict((template['Name'], template['Data'])
+                         for template in self.snapshot.templates(self.pool))
+        drift = {}
+        for node in self.snapshot.nodes(self.pool):
+            metadata = node.get('Metadata') or {}
+            name = metadata.get('template')
+            if name is None:
+                drift[node['Address']] = 'no template metadata'
+            elif name not in templates:
+                drift[node['Address']] = 'template "{}" no longer exists'.format(name)
+            else:
+                changed = sorted(item['Name'] for item in templates[name]
+                                 if metadata.get(item['Name']) != item['Value'])
+                if changed:
+                    drift[node['Address']] = 'template "{}" changed {}'.format(
+                        name, ", ".join(changed))
+        return drift
+
+    @timed("event_wait")
+    def wait_event(self, msg, max_retry=10, deadline=None, match=None, **kwargs):
+        return self.event_watcher.wait(msg, max_retry=max_retry,
+                                       deadline=deadline, match=match, **kwargs)
+
+    @timed("remove")
     def remove_node(self, node, curr_try=0, max_retry=10, retry_interval=60):
+        deadline = Deadline(self.deadline)
+        delays = self.backoff(retry_interval).delays()
         params = {"remove-iaas": "true", "address": node}
+        while True:
+            try:
+                self.client.nodes.remove(**params)
+                eventArgs = {
+                    "kindname": "node.delete",
+                    "target.type": "node",
+                    "target.value": node,
+                }
+                self.wait_event("Node delete", max_retry=max_retry,
+                                deadline=deadline, **eventArgs)
+                self.snapshot.invalidate("nodes")
+                return True
+            except Exception as ex:
+                if curr_try == max_retry:
+                    raise RemoveNodeFromPoolError("Maximum number of retries exceeded: {}".format(ex))
+                delay = next(delays)
+                if deadline.expired(delay):
+                    raise RemoveNodeFromPoolError("Deadline exceeded: {}".format(ex))
+                sys.stderr.write("Node delete failed: {}. Retrying in {} seconds.\n"
+                                 .format(ex, format_seconds(delay)))
+                self.retry_sleep("remove", delay)
+                curr_try += 1
+
+    def get_node_containers(self, node):
         try:
-            self.client.nodes.remove(**params)
-            eventArgs = {
-                "kindname": "node.delete",
-                "target.type": "node",
-                "target.value": node,
-            }
-            self.wait_event("Node delete", max_retry=max_retry, **eventArgs)
+            containers = self.client.nodes.request(
+                "get", "/docker/node/{}/containers".format(urllib.quote(node, safe="")))
         except Exception as ex:
-            if curr_try == max_retry:
-                raise RemoveNodeFromPoolError("Maximum number of retries exceeded: {}".format(ex))
-            sys.stderr.write("Node delete failed: {}. Retrying in {} seconds.\n"
-                             .format(ex, retry_interval))
-            time.sleep(retry_interval)
-            return self.remove_node(node, curr_try=curr_try+1,
-                                    max_retry=max_retry,
-                                    retry_interval=retry_interval)
-
-        return True
+            raise Exception('Error getting containers of node "{}": {}'.format(node, ex))
+        return containers or []
 
     @staticmethod
     def get_address(node_name):
@@ -164,79 +1157,1706 @@ class TsuruPool(object):
         except socket.error:
             return urlparse(node_name).hostname
 
+    @timed("healing")
     def disable_healing(self):
         sys.stdout.write("Disabling healing for pool.\n")
-        healing = self.client.healings.list()
-        if self.pool in healing:
+        healing = self.snapshot.healing(self.pool)
+        if healing is not None:
             def clean_up():
                 sys.stdout.write("Re-enabling healing for pool.\n")
-                self.client.healings.update(**{"pool": self.pool,
-                                               "Enabled": healing[self.pool]["Enabled"]})
+                with self.metrics.timer("phase", "healing"):
+                    self.client.healings.update(**{"pool": self.pool,
+                                                   "Enabled": healing["Enabled"]})
+                self.snapshot.invalidate("healings")
         else:
             def clean_up():
                 sys.stdout.write("Removing disabled healing.\n")
-                self.client.healings.remove(self.pool)
+                with self.metrics.timer("phase", "healing"):
+                    self.client.healings.remove(self.pool)
+                self.snapshot.invalidate("healings")
         self.client.healings.update(**{"pool": self.pool, "Enabled": False})
+        self.snapshot.invalidate("healings")
         return clean_up
 
+    @timed("disable")
+    def disable_nodes(self, nodes):
+        """Disables nodes, so tsuru places no container on them, and returns
+        a clean up re-enabling those still in the pool. Nodes that were
+        already disabled are left alone."""
+        statuses = dict((node['Address'], node.get('Status'))
+                        for node in self.snapshot.nodes(self.pool))
+        nodes = [node for node in nodes if statuses.get(node) != "disabled"]
 
-def pool_recycle(pool_name, dry_mode=False, max_retry=10, retry_interval=60):
-    pool_handler = TsuruPool(pool_name)
+        def enable(nodes):
+            for node in nodes:
+                self.client.nodes.update(node, Address=node, Enable="true")
+            self.snapshot.invalidate("nodes")
+
+        if nodes:
+            sys.stdout.write("Disabling {} node(s) to be recycled.\n".format(len(nodes)))
+        disabled = []
+        try:
+            for node in nodes:
+                self.client.nodes.update(node, Address=node, Disable="true")
+                disabled.append(node)
+        except Exception as ex:
+            enable(disabled)
+            raise Exception('Error disabling node "{}": {}'.format(node, ex))
+        self.snapshot.invalidate("nodes")
+
+        def clean_up():
+            remaining = set(self.get_nodes())
+            left = [node for node in disabled if node in remaining]
+            if left:
+                sys.stdout.write("Re-enabling {} node(s) left in pool.\n".format(len(left)))
+                with self.metrics.timer("phase", "disable"):
+                    enable(left)
+        return clean_up
+
+
+class RecycleJournal(object):
+    """Append-only record of every recycle step, one JSON object per line.
+
+    A run starts with a "start" entry listing the planned cycles. Each
+    cycle then goes through "create_requested", "created",
+    "remove_requested" and "removed". Progress is read back from the
+    entries after the last "start". A journal without a path records
+    nothing.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def record(self, step, **fields):
+        if self.path is None:
+            return
+        fields.update(step=step, time=time.time())
+        line = json.dumps(fields) + "\n"
+        with self._lock:
+            journal_dir = os.path.dirname(self.path)
+            if journal_dir and not os.path.isdir(journal_dir):
+                os.makedirs(journal_dir)
+            with open(self.path, "a") as journal_file:
+                journal_file.write(line)
+                journal_file.flush()
+                os.fsync(journal_file.fileno())
+
+    def entries(self):
+        if self.path is None or not os.path.exists(self.path):
+            return []
+        entries = []
+        with open(self.path) as journal_file:
+            for line in journal_file:
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    # a run killed mid-write leaves a truncated last line
+                    continue
+        return entries
+
+    def progress(self):
+        entries = self.entries()
+        starts = [idx for idx, entry in enumerate(entries) if entry["step"] == "start"]
+        if not starts:
+            return None
+        return RecycleProgress(entries[starts[-1]], entries[starts[-1]+1:])
+
+
+class RecycleProgress(object):
+
+    def __init__(self, start, entries):
+        self.cycles = [(node, template) for node, template in start["cycles"]]
+        self.requested = []
+        self.created = {}
+        self.removed = set()
+        for entry in entries:
+            if entry["step"] == "create_requested":
+                self.requested.append(entry["node"])
+            elif entry["step"] == "created":
+                self.created[entry["node"]] = entry["new_node"]
+            elif entry["step"] == "removed":
+                self.removed.add(entry["node"])
+
+    def pending_cycles(self, pool_nodes):
+        """Returns the cycles still to run, with their replacement node when
+        a previous run already created it.
+
+        Replacements requested but never recorded as created are matched
+        with pool nodes that were neither in the original pool nor
+        recorded as a replacement.
+        """
+        original = set(node for node, _ in self.cycles)
+        known = set(self.created.values())
+        orphans = [node for node in pool_nodes
+                   if node not in original and node not in known]
+        cycles = []
+        for node, template in self.cycles:
+            if node in self.removed and node not in self.created:
+                # removed before its replacement was created
+                new_node = orphans.pop(0) if node in self.requested and orphans else None
+                if new_node is None:
+                    cycles.append((node, template, None))
+                continue
+            if node in self.removed or node not in pool_nodes:
+                continue
+            new_node = self.created.get(node)
+            if new_node is not None and new_node not in pool_nodes:
+                new_node = None
+            if new_node is None and node in self.requested and orphans:
+                new_node = orphans.pop(0)
+            cycles.append((node, template, new_node))
+        return cycles
+
+
+class TemplateHealth(object):
+    """Circuit breaker over node creations, one per template.
+
+    A template's breaker opens after threshold consecutive failed
+    creations, and the template is then skipped. After cooldown seconds
+    it half-opens: the template looks healthy again until one creation
+    claims the probe. A successful probe closes the breaker, a failed one
+    opens it for another cooldown.
+    """
+
+    def __init__(self, threshold=3, cooldown=300):
+        self.threshold = max(1, threshold)
+        self.cooldown = cooldown
+        self._failures = {}
+        self._opened = {}
+        self._probing = set()
+        self._lock = threading.Lock()
+
+    def _state(self, template):
+        if template not in self._opened:
+            return "closed"
+        if time.time() - self._opened[template] >= self.cooldown:
+            return "half-open"
+        return "open"
+
+    def state(self, template):
+        with self._lock:
+            return self._state(template)
+
+    def attempt(self, template):
+        """Claims the probe of a half-open template before creating a node."""
+        with self._lock:
+            if self._state(template) == "half-open":
+                self._probing.add(template)
+
+    def failed(self, template):
+        """Records a failed creation. Returns whether it opened the breaker."""
+        with self._lock:
+            self._failures[template] = self._failures.get(template, 0) + 1
+            was_open = self._state(template) == "open"
+            if template in self._probing or self._failures[template] >= self.threshold:
+                self._probing.discard(template)
+                self._opened[template] = time.time()
+            return not was_open and self._state(template) == "open"
+
+    def succeeded(self, template):
+        with self._lock:
+            self._failures.pop(template, None)
+            self._opened.pop(template, None)
+            self._probing.discard(template)
+
+    def is_healthy(self, template):
+        with self._lock:
+            state = self._state(template)
+            return state == "closed" or (state == "half-open" and template not in self._probing)
+
+
+class TemplatePlanner(object):
+    """Assigns templates to replacement nodes so the pool ends up balanced
+    according to template weights.
+
+    Nodes already backed by each template and staying in the pool count
+    towards its share. Every assignment goes to the healthy template
+    furthest below its share, so templates are also interleaved while the
+    recycle runs. With equal weights and no kept nodes this is a plain
+    round-robin.
+    """
+
+    def __init__(self, templates, weights=None, kept=None, health=None):
+        weights = weights or {}
+        unknown = set(weights) - set(templates)
+        if unknown:
+            raise Exception('Templates not associated with the pool: {}'
+                            .format(", ".join(sorted(unknown))))
+        self.templates = list(templates)
+        self.weights = dict((template, float(weights.get(template, 1)))
+                            for template in self.templates)
+        self.counts = dict((template, (kept or {}).get(template, 0))
+                           for template in self.templates)
+        self.total = sum(self.counts.values())
+        self.health = health or TemplateHealth()
+        self._lock = threading.Lock()
+
+    def _healthy(self):
+        return [template for template in self.templates
+                if self.weights[template] > 0 and self.health.is_healthy(template)]
+
+    def _pick(self):
+        # with every template failing, creations keep retrying on their own
+        # template, so new assignments just follow the weights
+        healthy = self._healthy() or [template for template in self.templates
+                                      if self.weights[template] > 0]
+        if not healthy:
+            raise NewNodeError("No template with a positive weight")
+        total_weight = sum(self.weights[template] for template in healthy)
+        final = self.total + 1
+
+        def deficit(template):
+            share = final * self.weights[template] / total_weight
+            return (share - self.counts[template], -self.templates.index(template))
+        return max(healthy, key=deficit)
+
+    def _take(self, template):
+        self.counts[template] = self.counts.get(template, 0) + 1
+        self.total += 1
+        return template
+
+    def assign(self, count):
+        with self._lock:
+            return [self._take(self._pick()) for _ in range(count)]
+
+    def add(self, template):
+        """Counts a template assigned elsewhere, e.g. by a previous run."""
+        with self._lock:
+            self._take(template)
+
+    def reassign(self, template):
+        """Moves one planned node off template if it is unhealthy and
+        another template is healthy."""
+        with self._lock:
+            if self.health.is_healthy(template) or template not in self.counts or \
+                    not self._healthy():
+                return template
+            self.counts[template] -= 1
+            self.total -= 1
+            return self._take(self._pick())
+
+    def distribution(self):
+        with self._lock:
+            return [(template, self.counts[template]) for template in self.templates]
+
+
+class RecycleCycle(object):
+
+    def __init__(self, idx, node, template, new_node=None, containers=None,
+                 removed=False):
+        self.idx = idx
+        self.node = node
+        self.template = template
+        self.new_node = new_node
+        self.containers = containers
+        self.removed = removed
+
+
+def water_level(loads, amount):
+    """Returns the container count reached when amount containers are spread
+    over nodes with the given loads, always filling the least loaded first,
+    which is how tsuru places rebalanced containers."""
+    ordered = sorted(loads)
+    filled = 0
+    for idx, load in enumerate(ordered):
+        if idx + 1 < len(ordered):
+            capacity = (ordered[idx + 1] - load) * (idx + 1)
+        else:
+            capacity = float("inf")
+        if filled + capacity >= amount:
+            return load + float(amount - filled) / (idx + 1)
+        filled += capacity
+    return 0
+
+
+class MigrationModel(object):
+    """Estimates container moves while old nodes are removed one by one.
+
+    Containers of a removed node spread over the remaining nodes, old and
+    fresh, least loaded first. Containers landing on an old node move again
+    when that node is removed.
+    """
+
+    def __init__(self, loads, pre_provisioned=False):
+        self.old = dict(loads)
+        self.fresh = [0] * len(loads) if pre_provisioned else []
+        self.pre_provisioned = pre_provisioned
+        self.moves = 0
+
+    def spread(self, node):
+        others = [load for other, load in self.old.items() if other != node]
+        fresh = self.fresh if self.pre_provisioned else self.fresh + [0]
+        level = water_level(others + fresh, self.old[node])
+        return level, sum(max(0, level - load) for load in others)
+
+    def spills(self):
+        """Returns, by old node, the containers its removal would place on
+        the other old nodes, as spread does, with prefix sums over the
+        sorted loads so every node is evaluated in logarithmic time."""
+        loads = sorted(self.old.values() + self.fresh + ([] if self.pre_provisioned else [0]))
+        totals = [0]
+        for load in loads:
+            totals.append(totals[-1] + load)
+        old = sorted(self.old.values())
+        old_totals = [0]
+        for load in old:
+            old_totals.append(old_totals[-1] + load)
+
+        def nth(idx, skip):
+            # loads without the one at position skip
+            return loads[idx] if idx < skip else loads[idx + 1]
+
+        def total(count, skip, amount):
+            return totals[count] if count <= skip else totals[count + 1] - amount
+
+        spills = {}
+        for node, amount in self.old.items():
+            skip = bisect.bisect_left(loads, amount)
+            # the most of the least loaded nodes that amount fills up to the
+            # load of the highest of them
+            low, high = 1, len(loads) - 1
+            while low < high:
+                mid = (low + high + 1) // 2
+                if mid * nth(mid - 1, skip) - total(mid, skip, amount) <= amount:
+                    low = mid
+                else:
+                    high = mid - 1
+            level = nth(low - 1, skip) + float(amount - (low * nth(low - 1, skip) -
+                                                         total(low, skip, amount))) / low
+            below = bisect.bisect_left(old, level)
+            spilled = old_totals[below]
+            if amount < level:
+                below, spilled = below - 1, spilled - amount
+            spills[node] = below * level - spilled if below else 0
+        return spills
+
+    def remove(self, node):
+        level, _ = self.spread(node)
+        self.moves += self.old.pop(node)
+        if not self.pre_provisioned:
+            self.fresh.append(0)
+        self.old = dict((other, max(load, level)) for other, load in self.old.items())
+        self.fresh = [max(load, level) for load in self.fresh]
+
+
+def order_nodes(loads, order="api", pre_provisioned=False):
+    """Returns nodes in recycle order and the container moves the order is
+    expected to cause. loads is a list of (node, container count) pairs in
+    the order tsuru listed them."""
+    if order == "least-loaded":
+        nodes = [node for node, _ in sorted(loads, key=lambda item: item[1])]
+    elif order == "most-loaded":
+        nodes = [node for node, _ in sorted(loads, key=lambda item: -item[1])]
+    elif order == "min-migration":
+        # greedily remove the node whose containers spill the least onto
+        # nodes that are still waiting to be recycled
+        model = MigrationModel(loads, pre_provisioned)
+        nodes = []
+        position = dict((node, idx) for idx, (node, _) in enumerate(loads))
+        while model.old:
+            spills = model.spills()
+            node = min(model.old, key=lambda node: (spills[node], model.old[node], position[node]))
+            model.remove(node)
+            nodes.append(node)
+    else:
+        nodes = [node for node, _ in loads]
+    model = MigrationModel(loads, pre_provisioned)
+    for node in nodes:
+        model.remove(node)
+    return nodes, model.moves
+
+
+ORDERS = ["api", "least-loaded", "most-loaded", "min-migration"]
+
+
+class SlowStart(object):
+    """Adaptive limit on how many recycle jobs run at once.
+
+    The limit starts at one and doubles every time a whole batch (as many
+    jobs as the current limit) finishes cleanly, up to the ceiling. It is
+    halved when a job fails, when creates or removals had to be retried
+    since the last job finished, or when a job takes spike_factor times
+    longer than the median of earlier jobs of the same phase.
+    """
+
+    def __init__(self, ceiling, metrics=None, spike_factor=3):
+        self.ceiling = max(1, ceiling)
+        self.limit = 1
+        self.metrics = metrics or RecycleMetrics()
+        self.spike_factor = spike_factor
+        self.in_flight = 0
+        self.successes = 0
+        self.durations = {}
+        self._retries = self._retry_count()
+        self._cond = threading.Condition()
+
+    def _retry_count(self):
+        return self.metrics.counter("create", "retries") + self.metrics.counter("remove", "retries")
+
+    def acquire(self, stopped):
+        with self._cond:
+            while self.in_flight >= self.limit and not stopped.is_set():
+                self._cond.wait(0.5)
+            self.in_flight += 1
+
+    def cancel(self):
+        """Gives back a slot acquired for a job that did not run."""
+        with self._cond:
+            self.in_flight -= 1
+            self._cond.notify_all()
+
+    def release(self, phase, seconds, failed=False):
+        with self._cond:
+            self.in_flight -= 1
+            durations = self.durations.setdefault(phase, [])
+            retries, self._retries = self._retries, self._retry_count()
+            if failed:
+                self._lower("job failed")
+            elif self._retries > retries:
+                self._lower("{} retries".format(self._retries - retries))
+            elif len(durations) >= 2 and seconds > self.spike_factor * percentile(durations, 50):
+                self._lower("{} took {} seconds".format(phase, format_seconds(seconds)))
+            else:
+                self.successes += 1
+                if self.successes >= self.limit and self.limit < self.ceiling:
+                    self._set_limit(min(self.ceiling, self.limit * 2), "raised", "batch succeeded")
+            durations.append(seconds)
+            self._cond.notify_all()
+
+    def _lower(self, reason):
+        if self.limit > 1:
+            self._set_limit(max(1, self.limit // 2), "lowered", reason)
+        self.successes = 0
+
+    def _set_limit(self, limit, action, reason):
+        self.limit = limit
+        self.successes = 0
+        self.metrics.increment("concurrency", action)
+        sys.stdout.write("Concurrency {} to {}: {}.\n".format(action, limit, reason))
+
+
+def acquire_unless_stopped(lock, stopped, poll=0.1):
+    """Acquires lock, or gives up and returns False once stopped is set."""
+    while not lock.acquire(False):
+        if stopped.is_set():
+            return False
+        time.sleep(poll)
+    return True
+
+
+class RecycleWorkers(object):
+    """Runs recycle jobs on a bounded pool of worker threads.
+
+    The first job that fails stops the workers from picking up new jobs;
+    jobs already running are allowed to finish before the error is raised
+    again on the calling thread. Workers sharing a stopped event stop
+    together, and a budget semaphore shared between workers caps how many
+    of their jobs run at once overall. A SlowStart throttle further limits
+    running jobs while it ramps up, timing them under the given phase.
+    """
+
+    def __init__(self, size=1, stopped=None, budget=None, throttle=None,
+                 phase="cycle"):
+        self.size = max(1, size)
+        self.stopped = stopped or threading.Event()
+        self.budget = budget
+        self.throttle = throttle
+        self.phase = phase
+        self.error = None
+        self._lock = threading.Lock()
+
+    def run(self, jobs):
+        queue = Queue.Queue()
+        for job in jobs:
+            queue.put(job)
+        threads = []
+        for _ in range(min(self.size, queue.qsize())):
+            thread = threading.Thread(target=self._work, args=(queue,))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        try:
+            for thread in threads:
+                # joining with a timeout keeps the main thread responsive
+                # to KeyboardInterrupt
+                while thread.is_alive():
+                    thread.join(0.5)
+        except KeyboardInterrupt:
+            self.stopped.set()
+            raise
+        if self.error is not None:
+            raise self.error[0], self.error[1], self.error[2]
+
+    def _work(self, queue):
+        while not self.stopped.is_set():
+            try:
+                job = queue.get_nowait()
+            except Queue.Empty:
+                return
+            if self.throttle is not None:
+                self.throttle.acquire(self.stopped)
+            if self.budget is not None and not acquire_unless_stopped(self.budget, self.stopped):
+                if self.throttle is not None:
+                    self.throttle.cancel()
+                return
+            start = time.time()
+            failed = False
+            try:
+                if not self.stopped.is_set():
+                    job()
+            except Exception:
+                failed = True
+                with self._lock:
+                    if self.error is None:
+                        self.error = sys.exc_info()
+                self.stopped.set()
+            finally:
+                if self.budget is not None:
+                    self.budget.release()
+                if self.throttle is not None:
+                    self.throttle.release(self.phase, time.time() - start, failed)
+
+
+def provision_node(pool_handler, cycle, label, journal, max_retry=10,
+                   retry_interval=60, planner=None):
+    if cycle.new_node is not None:
+        sys.stdout.write('{} Reusing node {} created on pool "{}" by a previous run\n'
+                         .format(label, cycle.new_node, pool_handler.pool))
+        return cycle.new_node
+    if planner is not None:
+        template = planner.reassign(cycle.template)
+        if template != cycle.template:
+            sys.stdout.write('{} Template "{}" is failing, using "{}" instead\n'
+                             .format(label, cycle.template, template))
+            cycle.template = template
+    sys.stdout.write('{} Creating new node on pool "{}" using "{}" template\n'
+                     .format(label, pool_handler.pool, cycle.template))
+    journal.record("create_requested", node=cycle.node, template=cycle.template)
+
+    def failover(template):
+        cycle.template = template
+    cycle.new_node = pool_handler.create_new_node(cycle.template, max_retry=max_retry,
+                                                  retry_interval=retry_interval,
+                                                  planner=planner, on_failover=failover)
+    journal.record("created", node=cycle.node, new_node=cycle.new_node)
+    sys.stdout.write('Node {} successfully created.\n'.format(cycle.new_node))
+    return cycle.new_node
+
+
+def decommission_node(pool_handler, cycle, journal, max_retry=10,
+                      retry_interval=60):
+    if cycle.removed:
+        return True
+    sys.stdout.write('Removing node "{}" from pool "{}"\n'
+                     .format(cycle.node, pool_handler.pool))
+    journal.record("remove_requested", node=cycle.node)
+    pool_handler.remove_node(cycle.node, max_retry=max_retry,
+                             retry_interval=retry_interval)
+    journal.record("removed", node=cycle.node)
+    cycle.removed = True
+    return True
+
+
+def recycle_node(pool_handler, cycle, label, journal, max_retry=10,
+                 retry_interval=60, planner=None):
+    new_node = provision_node(pool_handler, cycle, label, journal, max_retry=max_retry,
+                              retry_interval=retry_interval, planner=planner)
+    decommission_node(pool_handler, cycle, journal, max_retry=max_retry,
+                      retry_interval=retry_interval)
+    return new_node
+
+
+def pre_provision_nodes(pool_handler, cycles, total, journal, max_retry=10,
+                        retry_interval=60, parallel=1, stopped=None,
+                        budget=None, planner=None, throttle=None):
+    def create_job(cycle):
+        label = '({}/{})'.format(cycle.idx+1, total)
+        return lambda: provision_node(pool_handler, cycle, label, journal,
+                                      max_retry=max_retry, retry_interval=retry_interval,
+                                      planner=planner)
+
+    def remove_job(cycle):
+        return lambda: decommission_node(pool_handler, cycle, journal,
+                                         max_retry=max_retry,
+                                         retry_interval=retry_interval)
+
+    # every replacement is requested at once so IaaS boot times overlap
+    try:
+        RecycleWorkers(len(cycles), stopped=stopped, budget=budget,
+                       throttle=throttle, phase="create").run(
+            [create_job(cycle) for cycle in cycles])
+    except (Exception, KeyboardInterrupt):
+        new_nodes = [cycle.new_node for cycle in cycles if cycle.new_node is not None]
+        if new_nodes:
+            sys.stderr.write('Pre-provisioned nodes left on pool "{}": {}\n'
+                             .format(pool_handler.pool, ", ".join(new_nodes)))
+        raise
+    sys.stdout.write('{} node(s) pre-provisioned on pool "{}".\n'
+                     .format(len(cycles), pool_handler.pool))
+    RecycleWorkers(parallel, stopped=stopped, budget=budget,
+                   throttle=throttle, phase="remove").run(
+        [remove_job(cycle) for cycle in cycles])
+
+
+def pipeline_nodes(pool_handler, cycles, total, journal, max_retry=10,
+                   retry_interval=60, parallel=1, look_ahead=1, stopped=None,
+                   budget=None, planner=None, throttle=None):
+    """Creates replacements up to look_ahead nodes ahead of the parallel
+    nodes being removed, so new nodes boot while old ones drain.
+
+    A node is only removed once its replacement is up, so the pool never
+    has fewer nodes than when the recycle started, and at most parallel
+    plus look_ahead more.
+    """
+    stopped = stopped or threading.Event()
+    # one slot per node created and not yet replaced
+    slots = threading.Semaphore(parallel + look_ahead)
+    ready = Queue.Queue()
+
+    def create_job(cycle):
+        label = '({}/{})'.format(cycle.idx+1, total)
+
+        def job():
+            if not acquire_unless_stopped(slots, stopped):
+                return
+            # the budget and throttle are taken only once a slot is free, so
+            # waiting creations don't hold them from removals or other pools;
+            # the slot and budget go to the remover once the node is ready
+            budgeted = handed = False
+            try:
+                if budget is not None:
+                    if not acquire_unless_stopped(budget, stopped):
+                        return
+                    budgeted = True
+                if throttle is not None:
+                    throttle.acquire(stopped)
+                    if stopped.is_set():
+                        throttle.cancel()
+                        return
+                start = time.time()
+                failed = True
+                try:
+                    provision_node(pool_handler, cycle, label, journal, max_retry=max_retry,
+                                   retry_interval=retry_interval, planner=planner)
+                    failed = False
+                finally:
+                    if throttle is not None:
+                        throttle.release("create", time.time() - start, failed)
+                ready.put(cycle)
+                handed = True
+            finally:
+                if not handed:
+                    release(budgeted)
+        return job
+
+    def release(budgeted=True):
+        slots.release()
+        if budgeted and budget is not None:
+            budget.release()
+
+    def remove_job():
+        while not stopped.is_set():
+            try:
+                cycle = ready.get(timeout=0.5)
+            except Queue.Empty:
+                continue
+            try:
+                decommission_node(pool_handler, cycle, journal, max_retry=max_retry,
+                                  retry_interval=retry_interval)
+            finally:
+                release()
+            return
+
+    creators = RecycleWorkers(parallel + look_ahead, stopped=stopped)
+    removers = RecycleWorkers(parallel, stopped=stopped)
+    try:
+        RecycleWorkers(2, stopped=stopped).run([
+            lambda: creators.run([create_job(cycle) for cycle in cycles]),
+            lambda: removers.run([remove_job] * len(cycles))])
+    except (Exception, KeyboardInterrupt):
+        new_nodes = []
+        while not ready.empty():
+            new_nodes.append(ready.get().new_node)
+            release()
+        if new_nodes:
+            sys.stderr.write('Replacement nodes left on pool "{}": {}\n'
+                             .format(pool_handler.pool, ", ".join(new_nodes)))
+        raise
+
+
+def parse_capacity(value):
+    """Parses a node count, such as "2", or a share of the pool, such as
+    "25%"."""
+    try:
+        if value.endswith("%"):
+            float(value[:-1])
+        else:
+            int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid node count or percentage: {}".format(value))
+    return value
+
+
+def resolve_capacity(value, total, round_up=False):
+    if value is None:
+        return None
+    if not str(value).endswith("%"):
+        return int(value)
+    nodes = float(value[:-1]) * total / 100
+    return int(math.ceil(nodes) if round_up else math.floor(nodes))
+
+
+def capacity_limits(pool_handler, max_surge=None, max_unavailable=None):
+    """Returns the surge and unavailable node counts for the pool, with
+    percentages taken of its current size."""
+    pool_size = len(pool_handler.get_nodes())
+    surge = resolve_capacity(max_surge, pool_size, round_up=True)
+    unavailable = resolve_capacity(max_unavailable, pool_size) or 0
+    if surge is None:
+        surge = 1
+    if not surge and not unavailable:
+        raise Exception('--max-surge and --max-unavailable are both 0 for pool "{}"'
+                        .format(pool_handler.pool))
+    return surge, unavailable
+
+
+class CapacityBudget(object):
+    """How far a pool may grow above, or shrink below, its size before
+    the recycle.
+
+    A cycle holding a "surge" slot creates its replacement before
+    removing the old node; one holding an "unavailable" slot removes the
+    old node first. Surge slots are preferred, so capacity is only given
+    up when the surge budget is in use.
+    """
+
+    def __init__(self, surge=1, unavailable=0):
+        self.limits = {"surge": surge, "unavailable": unavailable}
+        self.used = {"surge": 0, "unavailable": 0}
+        self._cond = threading.Condition()
+
+    def acquire(self, stopped):
+        with self._cond:
+            while not stopped.is_set():
+                for kind in ["surge", "unavailable"]:
+                    if self.used[kind] < self.limits[kind]:
+                        self.used[kind] += 1
+                        return kind
+                self._cond.wait(0.5)
+            return None
+
+    def release(self, kind):
+        with self._cond:
+            self.used[kind] -= 1
+            self._cond.notify_all()
+
+
+def rolling_recycle_nodes(pool_handler, cycles, total, journal, max_retry=10,
+                          retry_interval=60, max_surge=1, max_unavailable=0,
+                          stopped=None, budget=None, planner=None, throttle=None):
+    capacity = CapacityBudget(max_surge, max_unavailable)
+    stopped = stopped or threading.Event()
+    sys.stdout.write('Recycling pool "{}" with at most {} extra and {} missing node(s).\n'
+                     .format(pool_handler.pool, max_surge, max_unavailable))
+
+    def cycle_job(cycle):
+        label = '({}/{})'.format(cycle.idx+1, total)
+
+        def job():
+            kind = capacity.acquire(stopped)
+            if kind is None:
+                return
+            try:
+                if kind == "unavailable" or cycle.removed:
+                    decommission_node(pool_handler, cycle, journal, max_retry=max_retry,
+                                      retry_interval=retry_interval)
+                provision_node(pool_handler, cycle, label, journal, max_retry=max_retry,
+                               retry_interval=retry_interval, planner=planner)
+                decommission_node(pool_handler, cycle, journal, max_retry=max_retry,
+                                  retry_interval=retry_interval)
+            finally:
+                capacity.release(kind)
+        return job
+
+    try:
+        RecycleWorkers(max_surge + max_unavailable, stopped=stopped, budget=budget,
+                       throttle=throttle).run([cycle_job(cycle) for cycle in cycles])
+    except (Exception, KeyboardInterrupt):
+        missing = [cycle.node for cycle in cycles if cycle.removed and cycle.new_node is None]
+        if missing:
+            sys.stderr.write('Nodes removed from pool "{}" without a replacement: {}\n'
+                             .format(pool_handler.pool, ", ".join(missing)))
+        raise
+
+
+class NodeSelector(object):
+    """Picks the nodes of a pool that need recycling.
+
+    only and exclude restrict the candidates to, or drop, the listed
+    addresses. Among candidates, nodes older than max_age seconds, or of
+    unknown age unless unknown_age is False, and nodes whose metadata
+    drifted from their template are selected when the matching filter is
+    set; with neither set, every candidate is.
+    """
+
+    def __init__(self, max_age=None, drift=False, only=None, exclude=None, unknown_age=True):
+        self.max_age = max_age
+        self.unknown_age = unknown_age
+        self.drift = drift
+        self.only = set(only) if only else None
+        self.exclude = set(exclude or [])
+
+    def select(self, pool_handler, nodes):
+        """Returns the selected nodes, in order, and the reason each of
+        them was selected."""
+        candidates = [node for node in nodes
+                      if (self.only is None or node in self.only) and node not in self.exclude]
+        if self.max_age is None and not self.drift:
+            return candidates, {}
+        reasons = {}
+        if self.drift:
+            reasons.update(pool_handler.get_template_drift())
+        if self.max_age is not None:
+            for node, age in pool_handler.get_node_ages().items():
+                if age is None:
+                    if self.unknown_age:
+                        reasons.setdefault(node, "age unknown")
+                elif age > self.max_age:
+                    reasons.setdefault(node, "{} days old".format(format_seconds(age / 86400)))
+        selected = [node for node in candidates if node in reasons]
+        return selected, dict((node, reasons[node]) for node in selected)
+
+
+JOURNAL_PATH = os.path.join("~", ".tsuru", "pool-recycle-{pool}.journal")
+
+
+def default_journal_path(pool_name):
+    return os.path.expanduser(JOURNAL_PATH.format(pool=pool_name))
+
+
+def plan_recycle(pool_handler, journal, resume=False, order="api",
+                 pre_provision=False, template_weights=None, selector=None):
     pool_templates = pool_handler.get_machines_templates()
     if pool_templates == []:
-        raise Exception('Pool "{}" does not contain any template associate'.format(pool_name))
+        raise Exception('Pool "{}" does not contain any template associate'
+                        .format(pool_handler.pool))
     templates_len = len(pool_templates)
-    template_idx = 0
-    nodes_to_recycle = pool_handler.get_nodes()
-    recycle_len = len(nodes_to_recycle)
+    pool_nodes = pool_handler.get_nodes()
+    containers = {}
+    if resume:
+        progress = journal.progress()
+        if progress is None:
+            raise Exception('No recycle of pool "{}" to resume in {}'
+                            .format(pool_handler.pool, journal.path))
+        planned = progress.pending_cycles(pool_nodes)
+        pool_nodes = [node for node, _, _ in planned]
+        sys.stdout.write('Resuming recycle of pool "{}": {} of {} node(s) left.\n'
+                         .format(pool_handler.pool, len(planned), len(progress.cycles)))
+    elif selector is not None:
+        total = len(pool_nodes)
+        pool_nodes, reasons = selector.select(pool_handler, pool_nodes)
+        sys.stdout.write('Selected {} of {} node(s) on pool "{}".\n'
+                         .format(len(pool_nodes), total, pool_handler.pool))
+        for node in pool_nodes:
+            if node in reasons:
+                sys.stdout.write('  {}: {}\n'.format(node, reasons[node]))
+    if not resume and order != "api":
+        counts = {}
+
+        def count(node):
+            counts[node] = len(pool_handler.get_node_containers(node))
+        run_concurrently([functools.partial(count, node) for node in pool_nodes], size=HTTP_POOL_SIZE)
+        # nodes whose count could not be fetched fail again here
+        loads = [(node, counts[node] if node in counts else len(pool_handler.get_node_containers(node)))
+                 for node in pool_nodes]
+        containers = dict(loads)
+        pool_nodes, moves = order_nodes(loads, order, pre_provisioned=pre_provision)
+
+    # templates are assigned up front so the distribution does not depend on
+    # which worker finishes first
+    recycled = set(pool_nodes)
+    kept = {}
+    for node, template in pool_handler.get_node_templates().items():
+        if node not in recycled and template is not None:
+            kept[template] = kept.get(template, 0) + 1
+    planner = TemplatePlanner(pool_templates, weights=template_weights, kept=kept,
+                              health=pool_handler.template_health)
+    if resume:
+        for _, template, new_node in planned:
+            if new_node is None:
+                planner.add(template)
+        current = set(pool_handler.get_nodes())
+        cycles = [RecycleCycle(idx, node, template, new_node, removed=node not in current)
+                  for idx, (node, template, new_node) in enumerate(planned)]
+    else:
+        cycles = [RecycleCycle(idx, node, template, containers=containers.get(node))
+                  for idx, (node, template)
+                  in enumerate(zip(pool_nodes, planner.assign(len(pool_nodes))))]
     sys.stdout.write('Going to recycle {} node(s) from pool "{}" using {} templates.\n'
-                     .format(recycle_len, pool_name, len(pool_templates)))
-    enable_healing = pool_handler.disable_healing()
-    new_node = None
-    for idx, node in enumerate(nodes_to_recycle):
+                     .format(len(cycles), pool_handler.pool, templates_len))
+    if not resume and order != "api":
+        sys.stdout.write('Nodes ordered by "{}", about {} container move(s) expected.\n'
+                         .format(order, int(round(moves))))
+    if template_weights:
+        sys.stdout.write('Planned template distribution: {}\n'.format(
+            ", ".join('{}={}'.format(template, count)
+                      for template, count in planner.distribution())))
+    return cycles, planner
+
+
+def dry_run_destroy(cycle):
+    if cycle.containers is None:
+        sys.stdout.write('Destroying node "{}\n'.format(cycle.node))
+    else:
+        sys.stdout.write('Destroying node "{}" with {} container(s)\n'
+                         .format(cycle.node, cycle.containers))
+
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return "{}h{:02d}m".format(hours, minutes)
+    if minutes:
+        return "{}m{:02d}s".format(minutes, seconds)
+    return "{}s".format(seconds)
+
+
+def schedule_jobs(durations, workers):
+    """Runs jobs in order on the first free of the given workers.
+
+    Returns when the last job finishes and the jobs run by the worker
+    finishing last, which form the critical path.
+    """
+    finishes = [(0, []) for _ in range(max(1, workers))]
+    for idx, seconds in enumerate(durations):
+        finish, jobs = min(finishes, key=lambda worker: worker[0])
+        finishes.remove((finish, jobs))
+        finishes.append((finish + seconds, jobs + [idx]))
+    return max(finishes, key=lambda worker: worker[0]) if durations else (0, [])
+
+
+def estimate_pipeline(creates, remove_seconds, parallel=1, look_ahead=1):
+    """Simulates pipeline_nodes, assuming removals free their slots in
+    order. Returns the estimate and its critical path, as (step, index)
+    tuples."""
+    slots = parallel + look_ahead
+    removers = [(0, None)] * max(1, parallel)
+    ends = {}
+    after = {}
+    for idx, seconds in enumerate(creates):
+        start = 0
+        if idx >= slots:
+            start = ends[("remove", idx - slots)]
+            after[("create", idx)] = ("remove", idx - slots)
+        ends[("create", idx)] = start + seconds
+        free, last = min(removers)
+        removers.remove((free, last))
+        if last is not None and free > ends[("create", idx)]:
+            after[("remove", idx)] = ("remove", last)
+        else:
+            after[("remove", idx)] = ("create", idx)
+        ends[("remove", idx)] = max(free, ends[("create", idx)]) + remove_seconds
+        removers.append((ends[("remove", idx)], idx))
+    if not creates:
+        return 0, []
+    step = max((step for step in ends if step[0] == "remove"), key=lambda step: ends[step])
+    total = ends[step]
+    path = []
+    while step is not None:
+        path.append(step)
+        step = after.get(step)
+    return total, path[::-1]
+
+
+def estimate_recycle(cycles, create_seconds, remove_seconds, parallel=1,
+                     pre_provision=False, look_ahead=0):
+    """Estimates how long recycling cycles takes from typical node create
+    times by template and a typical node removal time.
+
+    Returns the estimate and its critical path, as (step, cycle, seconds)
+    tuples.
+    """
+    creates = [create_seconds[cycle.template] for cycle in cycles]
+    if look_ahead and not pre_provision:
+        total, path = estimate_pipeline(creates, remove_seconds, parallel, look_ahead)
+        return total, [(step, cycles[idx], creates[idx] if step == "create" else remove_seconds)
+                       for step, idx in path]
+    if pre_provision:
+        # every node is created at once, then removed parallel at a time
+        slowest = max(range(len(cycles)), key=lambda idx: creates[idx]) if cycles else None
+        removes, path = schedule_jobs([remove_seconds] * len(cycles), parallel)
+        critical = [("create", cycles[slowest], creates[slowest])] if cycles else []
+        critical.extend(("remove", cycles[idx], remove_seconds) for idx in path)
+        return (creates[slowest] if cycles else 0) + removes, critical
+    total, path = schedule_jobs([seconds + remove_seconds for seconds in creates], parallel)
+    critical = []
+    for idx in path:
+        critical.append(("create", cycles[idx], creates[idx]))
+        critical.append(("remove", cycles[idx], remove_seconds))
+    return total, critical
+
+
+def dry_run_estimate(pool_handler, cycles, parallel=1, pre_provision=False,
+                     look_ahead=0):
+    by_template, creations, removals = pool_handler.get_operation_durations()
+    if not creations or not removals:
+        sys.stdout.write('Not enough node.create and node.delete history to estimate '
+                         'the duration of pool "{}".\n'.format(pool_handler.pool))
+        return None
+    create_seconds = dict((template, percentile(durations, 50))
+                          for template, durations in by_template.items())
+    for cycle in cycles:
+        create_seconds.setdefault(cycle.template, percentile(creations, 50))
+    remove_seconds = percentile(removals, 50)
+    total, critical = estimate_recycle(cycles, create_seconds, remove_seconds,
+                                       parallel=parallel, pre_provision=pre_provision,
+                                       look_ahead=look_ahead)
+    if pre_provision:
+        mode = "all created at once"
+    elif look_ahead:
+        mode = "{} at a time, created {} ahead".format(parallel, look_ahead)
+    else:
+        mode = "{} at a time".format(parallel)
+    sys.stdout.write('Estimated duration of pool "{}": {} for {} node(s), {}.\n'.format(
+        pool_handler.pool, format_duration(total), len(cycles), mode))
+    sys.stdout.write('  typical node create: {}; node remove: {}\n'.format(
+        ", ".join('{} "{}"'.format(format_duration(create_seconds[template]), template)
+                  for template in sorted(set(cycle.template for cycle in cycles))),
+        format_duration(remove_seconds)))
+    if critical:
+        sys.stdout.write('  critical path: {}\n'.format(" -> ".join(
+            '{} {} ({})'.format(step, cycle.node, format_duration(seconds))
+            for step, cycle, seconds in critical)))
+    return total
+
+
+def dry_run_recycle(pool_handler, cycles, pre_provision=False):
+    recycle_len = len(cycles)
+    for cycle in cycles:
         sys.stdout.write('({}/{}) Creating new node on pool "{}" '
                          'using "{}" template\n'
-                         .format(idx+1, recycle_len,
-                                 pool_name, pool_templates[template_idx]))
-
-        if dry_mode:
-            sys.stdout.write('Destroying node "{}\n'.format(node))
-            template_idx = (template_idx + 1) % templates_len
+                         .format(cycle.idx+1, recycle_len, pool_handler.pool, cycle.template))
+        if not pre_provision:
+            dry_run_destroy(cycle)
             sys.stdout.write('\n')
-            continue
-
-        try:
-            new_node = pool_handler.create_new_node(pool_templates[template_idx],
-                                                    retry_interval=retry_interval)
-            sys.stdout.write('Node {} successfully created.\n'.format(new_node))
-            sys.stdout.write('Removing node "{}" from pool "{}"\n'
-                             .format(node, pool_name))
-            pool_handler.remove_node(node, max_retry=max_retry,
-                                     retry_interval=retry_interval)
-            template_idx = (template_idx + 1) % templates_len
-            new_node = None
-        except (Exception, KeyboardInterrupt), e:
-            sys.stderr.write("Failed: {}\n".format(e))
-            enable_healing()
-            sys.exit(1)
+    if pre_provision:
+        for cycle in cycles:
+            dry_run_destroy(cycle)
+        sys.stdout.write('\n')
+
+
+def run_recycle(pool_handler, cycles, journal, max_retry=10, retry_interval=60,
+                parallel=1, pre_provision=False, stopped=None, budget=None,
+                planner=None, throttle=None, look_ahead=0, max_surge=None,
+                max_unavailable=None):
+    recycle_len = len(cycles)
+
+    def cycle_job(cycle):
+        label = '({}/{})'.format(cycle.idx+1, recycle_len)
+        return lambda: recycle_node(pool_handler, cycle, label, journal,
+                                    max_retry=max_retry,
+                                    retry_interval=retry_interval,
+                                    planner=planner)
+
+    if pre_provision:
+        pre_provision_nodes(pool_handler, cycles, recycle_len, journal,
+                            max_retry=max_retry, retry_interval=retry_interval,
+                            parallel=parallel, stopped=stopped, budget=budget,
+                            planner=planner, throttle=throttle)
+    elif max_surge is not None or max_unavailable is not None:
+        # node counts, resolved by capacity_limits while planning
+        rolling_recycle_nodes(pool_handler, cycles, recycle_len, journal,
+                              max_retry=max_retry, retry_interval=retry_interval,
+                              max_surge=max_surge, max_unavailable=max_unavailable,
+                              stopped=stopped, budget=budget, planner=planner,
+                              throttle=throttle)
+    elif look_ahead:
+        pipeline_nodes(pool_handler, cycles, recycle_len, journal,
+                       max_retry=max_retry, retry_interval=retry_interval,
+                       parallel=parallel, look_ahead=look_ahead, stopped=stopped,
+                       budget=budget, planner=planner, throttle=throttle)
+    else:
+        RecycleWorkers(parallel, stopped=stopped, budget=budget,
+                       throttle=throttle).run(
+            [cycle_job(cycle) for cycle in cycles])
+    journal.record("done")
+
+
+class RecycleDaemon(object):
+    """Keeps pools fresh by recycling stale nodes a few at a time.
+
+    Every interval seconds the cluster listings are fetched again and the
+    selector picks stale nodes of each pool, which are queued for the
+    workers. The queue holds up to queue_size nodes; nodes left out are
+    picked again on a later evaluation. Nodes are only queued, and
+    recycled, inside the maintenance windows, when there are any.
+    Healing of a pool is disabled while any of its nodes is recycled.
+    """
+
+    # listings the selector and planner read, refreshed on every evaluation
+    listings = ["templates", "nodes", "healings"]
+
+    def __init__(self, handlers, selector, interval=300, queue_size=10, workers=1,
+                 windows=None, max_retry=10, retry_interval=60, template_weights=None,
+                 metrics=None, metrics_file=None, metrics_format="json"):
+        self.handlers = handlers
+        self.selector = selector
+        self.interval = interval
+        self.workers = workers
+        self.windows = windows
+        self.max_retry = max_retry
+        self.retry_interval = retry_interval
+        self.template_weights = template_weights
+        self.metrics = metrics or RecycleMetrics()
+        self.metrics_file = metrics_file
+        self.metrics_format = metrics_format
+        self.queue = Queue.Queue(queue_size)
+        self.stopped = threading.Event()
+        self.journal = RecycleJournal(None)
+        self.tracked = set()
+        # removed nodes may still show up in listings fetched before removal
+        self.removed = set()
+        self.in_progress = 0
+        self.finished = []
+        self._healings = {}
+        # serialize healing calls of a pool, without holding self._lock
+        # while tsuru answers
+        self._healing_locks = {}
+        self._lock = threading.Lock()
+
+    def evaluate(self):
+        """Queues the stale nodes of every pool not queued yet."""
+        handlers = self.handlers
+        handlers[0].snapshot.invalidate(*self.listings)
+        handlers[0].prefetch(self.listings)
+        if not in_windows(self.windows):
+            sys.stdout.write("Outside maintenance windows, no node queued.\n")
+            return
+        listed = set((handler.pool, node) for handler in handlers for node in handler.get_nodes())
+        with self._lock:
+            self.removed &= listed
+        for handler in handlers:
+            nodes = handler.get_nodes()
+            stale, reasons = self.selector.select(handler, nodes)
+            with self._lock:
+                stale = [node for node in stale if (handler.pool, node) not in self.tracked and
+                         (handler.pool, node) not in self.removed]
+            if not stale:
+                continue
+            planner = self.planner(handler, stale)
+            for node in stale:
+                cycle = RecycleCycle(0, node, planner.assign(1)[0])
+                try:
+                    self.queue.put_nowait((handler, cycle, planner))
+                except Queue.Full:
+                    sys.stdout.write('Work queue full, node "{}" of pool "{}" left for later.\n'
+                                     .format(node, handler.pool))
+                    break
+                with self._lock:
+                    self.tracked.add((handler.pool, node))
+                self.metrics.increment("daemon", "queued")
+                sys.stdout.write('Queued node "{}" of pool "{}": {}\n'
+                                 .format(node, handler.pool, reasons.get(node, "selected")))
 
-    enable_healing()
+    def planner(self, handler, stale):
+        with self._lock:
+            leaving = set(stale) | set(node for pool, node in self.tracked if pool == handler.pool)
+        kept = {}
+        for node, template in handler.get_node_templates().items():
+            if node not in leaving and template is not None:
+                kept[template] = kept.get(template, 0) + 1
+        return TemplatePlanner(handler.get_machines_templates(), weights=self.template_weights,
+                               kept=kept, health=handler.template_health)
+
+    def report(self):
+        now = time.time()
+        with self._lock:
+            self.finished = [at for at in self.finished if now - at < 3600]
+            recycled, in_progress = len(self.finished), self.in_progress
+        depth = self.queue.qsize()
+        self.metrics.set("daemon", "queue_depth", depth)
+        self.metrics.set("daemon", "in_progress", in_progress)
+        self.metrics.set("daemon", "recycled_last_hour", recycled)
+        sys.stdout.write("Queue depth {}, {} in progress, {} recycled in the last hour, "
+                         "{} failed since start.\n"
+                         .format(depth, in_progress, recycled,
+                                 self.metrics.counter("daemon", "failed")))
+        if self.metrics_file is not None:
+            try:
+                self.metrics.write(self.metrics_file, self.metrics_format)
+            except (IOError, OSError) as ex:
+                sys.stderr.write("Failed to write metrics to {}: {}\n".format(self.metrics_file, ex))
+
+    def healing_lock(self, handler):
+        with self._lock:
+            return self._healing_locks.setdefault(handler.pool, threading.Lock())
+
+    def hold_healing(self, handler):
+        with self.healing_lock(handler):
+            with self._lock:
+                count, enable = self._healings.get(handler.pool, (0, None))
+            if count == 0:
+                enable = handler.disable_healing()
+            with self._lock:
+                self._healings[handler.pool] = (count + 1, enable)
+
+    def release_healing(self, handler):
+        with self.healing_lock(handler):
+            with self._lock:
+                count, enable = self._healings[handler.pool]
+                self._healings[handler.pool] = (count - 1, enable)
+            if count == 1:
+                enable()
+
+    def recycle(self, handler, cycle, planner):
+        with self._lock:
+            self.in_progress += 1
+        try:
+            self.hold_healing(handler)
+            try:
+                recycle_node(handler, cycle, '[{}]'.format(handler.pool), self.journal,
+                             max_retry=self.max_retry, retry_interval=self.retry_interval,
+                             planner=planner)
+            finally:
+                self.release_healing(handler)
+            self.metrics.increment("daemon", "recycled")
+            with self._lock:
+                self.finished.append(time.time())
+        except Exception as ex:
+            self.metrics.increment("daemon", "failed")
+            sys.stderr.write('Failed to recycle node "{}" of pool "{}": {}\n'
+                             .format(cycle.node, handler.pool, ex))
+        finally:
+            with self._lock:
+                self.in_progress -= 1
+                self.tracked.discard((handler.pool, cycle.node))
+                if cycle.removed:
+                    self.removed.add((handler.pool, cycle.node))
+
+    def work(self):
+        while not self.stopped.is_set():
+            try:
+                handler, cycle, planner = self.queue.get(timeout=0.5)
+            except Queue.Empty:
+                continue
+            try:
+                # nodes queued before a window closed wait for the next one
+                if in_windows(self.windows):
+                    self.recycle(handler, cycle, planner)
+                else:
+                    with self._lock:
+                        self.tracked.discard((handler.pool, cycle.node))
+            finally:
+                self.queue.task_done()
+
+    def run(self, evaluations=None):
+        """Evaluates pools until interrupted, or evaluations times and
+        then until the queue is drained."""
+        sys.stdout.write("Recycling stale nodes of {} pool(s) every {}.\n"
+                         .format(len(self.handlers), format_duration(self.interval)))
+        threads = [threading.Thread(target=self.work) for _ in range(self.workers)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        try:
+            count = 0
+            while evaluations is None or count < evaluations:
+                try:
+                    self.evaluate()
+                except Exception as ex:
+                    sys.stderr.write("Failed to evaluate pools: {}\n".format(ex))
+                self.report()
+                count += 1
+                if evaluations is None or count < evaluations:
+                    self.stopped.wait(self.interval)
+            while self.queue.unfinished_tasks:
+                self.stopped.wait(0.5)
+        except KeyboardInterrupt:
+            sys.stdout.write("Stopping, waiting for {} node recycle(s) in progress.\n"
+                             .format(self.in_progress))
+        finally:
+            self.stopped.set()
+            for thread in threads:
+                while thread.is_alive():
+                    thread.join(0.5)
+        self.report()
+
+
+def pool_recycle(pool_name, dry_mode=False, max_retry=10, retry_interval=60,
+                 parallel=1, pre_provision=False, backoff="exponential",
+                 deadline=None, journal_path=None, resume=False,
+                 all_pools=False, max_in_flight=None, order="api",
+                 template_weights=None, metrics_file=None, metrics_format="json",
+                 http_pool_size=None, slow_start=False, read_rate=None,
+                 write_rate=None, max_age=None, drift=False, only=None,
+                 exclude=None, look_ahead=0, max_surge=None, max_unavailable=None,
+                 breaker_threshold=3, breaker_cooldown=300, disable_old_nodes=False,
+                 record=None, replay=None, replay_speed=1, daemon=False, interval=300,
+                 queue_size=10, windows=None, include_unknown_age=False):
+    pool_names = [pool_name] if isinstance(pool_name, basestring) else list(pool_name or [])
+    # a daemon runs for days, so it only keeps recent samples
+    metrics = RecycleMetrics(max_samples=1000 if daemon else None)
+    # one connection per worker, plus the event watcher and snapshot reads;
+    # grown once the recycles are planned
+    pool_handler = TsuruPool(pool_names[0] if pool_names else None,
+                             backoff=backoff, deadline=deadline, metrics=metrics,
+                             http_pool_size=http_pool_size or max(HTTP_POOL_SIZE,
+                                                                  (max_in_flight or parallel) + 2),
+                             read_rate=read_rate,
+                             write_rate=write_rate, breaker_threshold=breaker_threshold,
+                             breaker_cooldown=breaker_cooldown, record=record, replay=replay,
+                             replay_speed=replay_speed)
+    # every independent listing needed before the first action is fetched in
+    # one round trip; dry runs never need the current user
+    listings = ["templates", "nodes", "healings"]
+    if dry_mode:
+        listings.extend(["creations", "removals"])
+    pool_handler.prefetch(listings, user=not dry_mode)
+    if all_pools:
+        pool_names = pool_handler.snapshot.pools()
+    # every pool shares the same client, event watcher and cluster listings
+    handlers = [pool_handler.for_pool(name) for name in pool_names]
+
+    selector = None
+    if max_age is not None or drift or only or exclude:
+        # a daemon would recycle nodes without node.create history forever
+        selector = NodeSelector(max_age=max_age, drift=drift, only=only, exclude=exclude,
+                                unknown_age=not daemon or include_unknown_age)
+    if daemon:
+        if max_age is None and not drift:
+            raise Exception("Daemon mode needs a max age or drift policy")
+        # the daemon recycles one node at a time, through recycle_node
+        if dry_mode or resume or pre_provision or look_ahead or disable_old_nodes or \
+                max_surge is not None or max_unavailable is not None:
+            raise Exception("Daemon mode can't dry run, resume, pre-provision, look ahead, "
+                            "use a capacity budget or disable old nodes")
+        RecycleDaemon(handlers, selector, interval=interval, queue_size=queue_size,
+                      workers=parallel, windows=windows, max_retry=max_retry,
+                      retry_interval=retry_interval, template_weights=template_weights,
+                      metrics=metrics, metrics_file=metrics_file,
+                      metrics_format=metrics_format).run()
+        pool_handler.close()
+        return
+    # every pool is planned before any of them is touched, and whatever was
+    # disabled is enabled again when setting up a later pool fails
+    recycles = []
+    capacities = {}
+    try:
+        plans = []
+        for handler in handlers:
+            path = None
+            # replays leave the journal of real runs alone
+            if journal_path is not None and not dry_mode and replay is None:
+                path = os.path.expanduser(journal_path.format(pool=handler.pool))
+            journal = RecycleJournal(path)
+            cycles, planner = plan_recycle(handler, journal, resume=resume, order=order,
+                                           pre_provision=pre_provision,
+                                           template_weights=template_weights,
+                                           selector=selector)
+            # a pool with nothing to recycle needs no capacity budget
+            if cycles and (max_surge is not None or max_unavailable is not None):
+                capacities[handler.pool] = capacity_limits(handler, max_surge, max_unavailable)
+            plans.append((handler, cycles, journal, planner))
+        for handler, cycles, journal, planner in plans:
+            clean_ups = []
+            recycles.append((handler, cycles, journal, planner, clean_ups))
+            clean_ups.append(handler.disable_healing())
+            if disable_old_nodes and not dry_mode:
+                # containers of a removed node then move once, onto fresh nodes,
+                # instead of onto old nodes that are removed later on
+                clean_ups.append(handler.disable_nodes([cycle.node for cycle in cycles
+                                                        if not cycle.removed]))
+        if not resume:
+            for handler, cycles, journal, _ in plans:
+                journal.record("start", pool=handler.pool,
+                               cycles=[(cycle.node, cycle.template) for cycle in cycles])
+    except Exception as e:
+        sys.stderr.write("Failed: {}\n".format(e))
+        for _, _, _, _, clean_ups in recycles:
+            run_clean_ups(clean_ups)
+        pool_handler.close()
+        sys.exit(1)
+
+    if dry_mode:
+        estimates = []
+        for idx, (handler, cycles, journal, _, clean_ups) in enumerate(recycles):
+            try:
+                dry_run_recycle(handler, cycles, pre_provision=pre_provision)
+                workers = sum(capacities.get(handler.pool, [parallel]))
+                estimates.append(dry_run_estimate(handler, cycles, parallel=workers,
+                                                  pre_provision=pre_provision,
+                                                  look_ahead=look_ahead))
+            except Exception as e:
+                sys.stderr.write("Failed: {}\n".format(e))
+                for _, _, _, _, clean_ups in recycles[idx:]:
+                    run_clean_ups(clean_ups)
+                pool_handler.close()
+                sys.exit(1)
+            run_clean_ups(clean_ups)
+        if len(estimates) > 1 and None not in estimates:
+            # pools run side by side, roughly max_in_flight / parallel at a time
+            total = max(estimates)
+            if max_in_flight:
+                total = max(total, sum(estimates) * parallel / float(max_in_flight))
+            sys.stdout.write('Estimated duration of every pool: {}\n'.format(format_duration(total)))
+        pool_handler.close()
+        sys.stdout.write('Done.\n')
+        return
+
+    def pool_workers(handler, cycles):
+        if pre_provision:
+            return len(cycles)
+        if handler.pool in capacities:
+            return sum(capacities[handler.pool])
+        return min(len(cycles), parallel + look_ahead)
+
+    if http_pool_size is None:
+        # pre-provisioning and capacity budgets run more workers than
+        # --parallel, and connections beyond the pool size are thrown away
+        workers = sum(pool_workers(handler, cycles) for handler, cycles, _, _, _ in recycles)
+        pool_handler.grow_http_pool(min(workers, max_in_flight or workers) + 2)
+
+    stopped = threading.Event()
+    budget = None
+    if max_in_flight:
+        budget = threading.BoundedSemaphore(max_in_flight)
+    throttle = None
+    if slow_start:
+        # pre-provisioning creates every node of a pool at once, so its
+        # ramp is not capped by --parallel
+        rolling = max_surge is not None or max_unavailable is not None
+        ceiling = max(len(cycles) if pre_provision or rolling else parallel + look_ahead
+                      for _, cycles, _, _, _ in recycles) * len(recycles)
+        throttle = SlowStart(min(ceiling, max_in_flight or ceiling), metrics=metrics)
+    failures = []
+
+    def pool_job(handler, cycles, journal, planner):
+        surge, unavailable = capacities.get(handler.pool, (None, None))
+
+        def job():
+            try:
+                run_recycle(handler, cycles, journal, max_retry=max_retry,
+                            retry_interval=retry_interval, parallel=parallel,
+                            pre_provision=pre_provision, stopped=stopped,
+                            budget=budget, planner=planner, throttle=throttle,
+                            look_ahead=look_ahead, max_surge=surge,
+                            max_unavailable=unavailable)
+            except Exception as e:
+                failures.append((handler, journal, e))
+                stopped.set()
+        return job
+
+    try:
+        RecycleWorkers(len(recycles)).run([pool_job(*recycle[:4]) for recycle in recycles])
+    except KeyboardInterrupt, e:
+        stopped.set()
+        failures.append((None, None, e))
+
+    for handler, journal, e in failures:
+        if len(recycles) > 1 and handler is not None:
+            sys.stderr.write('Failed on pool "{}": {}\n'.format(handler.pool, e))
+        else:
+            sys.stderr.write("Failed: {}\n".format(e))
+        if journal is not None and journal.path is not None:
+            sys.stderr.write("Progress saved to {}. Run again with --resume to continue.\n"
+                             .format(journal.path))
+    for _, _, _, _, clean_ups in recycles:
+        run_clean_ups(clean_ups)
+    pool_handler.close()
+    report_metrics(metrics, metrics_file, metrics_format)
+    if failures:
+        sys.exit(1)
     sys.stdout.write('Done.\n')
 
 
+def run_clean_ups(clean_ups):
+    """Runs clean ups in reverse order, each one even if a previous failed."""
+    errors = []
+    for clean_up in reversed(clean_ups):
+        try:
+            clean_up()
+        except Exception as ex:
+            errors.append(ex)
+    if errors:
+        raise errors[0]
+
+
+def report_metrics(metrics, metrics_file=None, metrics_format="json"):
+    metrics.observe("phase", "run", time.time() - metrics.started)
+    sys.stdout.write("Timings, in seconds:\n")
+    for line in metrics.summary():
+        sys.stdout.write(line + "\n")
+    if metrics_file is not None:
+        try:
+            metrics.write(metrics_file, metrics_format)
+        except (IOError, OSError) as ex:
+            sys.stderr.write("Failed to write metrics to {}: {}\n".format(metrics_file, ex))
+
+
 def pool_recycle_parser(args):
     parser = argparse.ArgumentParser(description="Tsuru pool nodes recycle")
-    parser.add_argument("-p", "--pool", required=True,
-                        help="Tsuru pool")
+    pools = parser.add_mutually_exclusive_group(required=True)
+    pools.add_argument("-p", "--pool", nargs="+",
+                       help="Tsuru pools")
+    pools.add_argument("-a", "--all-pools", action='store_true',
+                       help="Recycle every pool with IaaS templates")
     parser.add_argument("-d", "--dry-run", required=False, action='store_true',
                         help="Dry run all recycle actions")
     parser.add_argument("-m", "--max_retry", required=False, default=10, type=int,
                         help="Max retries attempts to move a node on failure")
     parser.add_argument("-i", "--retry-interval", required=False, default=60, type=int,
                         help="Time, in seconds, between retry attempts.")
+    parser.add_argument("-n", "--parallel", required=False, default=1, type=int,
+                        help="Number of nodes recycled at the same time on each pool.")
+    parser.add_argument("--max-in-flight", required=False, default=None, type=int,
+                        help="Number of nodes recycled at the same time across all pools.")
+    parser.add_argument("--http-pool-size", required=False, default=None, type=int,
+                        help="Number of keep-alive connections kept open to the tsuru API. "
+                             "Defaults to the number of nodes recycled at the same time plus 2")
+    parser.add_argument("--read-rate", required=False, default=None, type=float,
+                        help="Maximum tsuru API read (GET) requests per second")
+    parser.add_argument("--write-rate", required=False, default=None, type=float,
+                        help="Maximum tsuru API requests per second that change state")
+    parser.add_argument("--pre_provision", required=False, action='store_true',
+                        help="Pre-provision all nodes on IaaS before start moving")
+    parser.add_argument("--look-ahead", required=False, default=0, type=int,
+                        help="Create up to this many replacement nodes ahead of the nodes "
+                             "being removed, so new nodes boot while old ones drain. Nodes "
+                             "are only removed once their replacement is up.")
+    parser.add_argument("--max-surge", required=False, default=None, type=parse_capacity,
+                        help="Replacement nodes that may exist before the nodes they replace "
+                             "are removed, as a count or a percentage of the pool. Defaults to 1. "
+                             "Overrides --parallel.")
+    parser.add_argument("--max-unavailable", required=False, default=None, type=parse_capacity,
+                        help="Nodes that may be removed before their replacement exists, as a "
+                             "count or a percentage of the pool. Defaults to 0. Overrides "
+                             "--parallel.")
+    parser.add_argument("--disable-old-nodes", required=False, action='store_true',
+                        help="Disable every node to be recycled before starting, so their "
+                             "containers move once, straight onto new nodes. Nodes left in the "
+                             "pool are enabled again at the end.")
+    parser.add_argument("--slow-start", required=False, action='store_true',
+                        help="Start recycling one node at a time, doubling concurrency after each "
+                             "successful batch and halving it on retries, failures or slow nodes")
+    parser.add_argument("-o", "--order", required=False, default="api", choices=ORDERS,
+                        help="Order nodes are recycled in, based on how many containers "
+                             "they run. min-migration picks the order expected to move "
+                             "the fewest containers. Defaults to the order tsuru lists them.")
+    parser.add_argument("-w", "--template-weight", required=False, action="append",
+                        default=[], metavar="TEMPLATE=WEIGHT",
+                        help="Share of the recycled pool backed by a template, relative "
+                             "to the other templates. Templates default to weight 1.")
+    parser.add_argument("--max-age", required=False, default=None, type=parse_duration,
+                        help="Only recycle nodes created longer ago than this, e.g. 12h or 7d. "
+                             "Nodes created before the oldest event tsuru keeps count as old.")
+    parser.add_argument("--drift", required=False, action='store_true',
+                        help="Only recycle nodes whose metadata no longer matches their IaaS "
+                             "template. Combined with --max-age, nodes matching either are "
+                             "recycled.")
+    parser.add_argument("--only", required=False, nargs="+", default=None, metavar="NODE",
+                        help="Only recycle these node addresses")
+    parser.add_argument("--exclude", required=False, nargs="+", default=None, metavar="NODE",
+                        help="Never recycle these node addresses")
+    parser.add_argument("--breaker-threshold", required=False, default=3, type=int,
+                        help="Consecutive failed node creations after which a template is "
+                             "skipped and nodes fail over to the pool's other templates")
+    parser.add_argument("--breaker-cooldown", required=False, default=300, type=parse_duration,
+                        help="Time a failing template is skipped before a node creation "
+                             "probes it again, e.g. 300 or 5m")
+    parser.add_argument("--daemon", required=False, action='store_true',
+                        help="Keep running, recycling the nodes selected by --max-age or "
+                             "--drift as they go stale, --parallel at a time")
+    parser.add_argument("--interval", required=False, default=300, type=parse_duration,
+                        help="Time between evaluations of the pools in --daemon mode, "
+                             "e.g. 300 or 5m")
+    parser.add_argument("--queue-size", required=False, default=10, type=int,
+                        help="Stale nodes queued at most in --daemon mode; the others wait "
+                             "for a later evaluation")
+    parser.add_argument("--window", required=False, default=[], action="append",
+                        type=parse_window,
+                        help="Daily UTC maintenance window in --daemon mode, e.g. 22:00-06:00. "
+                             "Nodes are only recycled inside a window. Can be repeated.")
+    parser.add_argument("--include-unknown-age", required=False, action='store_true',
+                        help="In --daemon mode, also recycle nodes tsuru keeps no node.create "
+                             "event of. One-shot runs with --max-age always do.")
+    parser.add_argument("--record", required=False, default=None, metavar="FILE",
+                        help="Write every tsuru API request and response, with timings, to "
+                             "FILE, to replay the run later")
+    parser.add_argument("--replay", required=False, default=None, metavar="FILE",
+                        help="Answer tsuru API requests from a trace written by --record, "
+                             "without reaching tsuru")
+    parser.add_argument("--replay-speed", required=False, default=1, type=float,
+                        help="Speed up, or slow down, a --replay by this factor. 0 replays "
+                             "without waiting.")
+    parser.add_argument("-b", "--backoff", required=False, default="exponential",
+                        choices=sorted(BACKOFF_POLICIES),
+                        help="How waits between event polls and retry attempts grow. "
+                             "Exponential waits start at 1 second and are capped by "
+                             "--retry-interval.")
+    parser.add_argument("--deadline", required=False, default=None, type=int,
+                        help="Max time, in seconds, to create or remove a single node, "
+                             "retries included.")
+    parser.add_argument("--metrics-file", required=False, default=None,
+                        help="File to write phase and tsuru API call timings to")
+    parser.add_argument("--metrics-format", required=False, default="json",
+                        choices=METRICS_FORMATS,
+                        help="JSON lines, or a Prometheus textfile collector file")
+    parser.add_argument("-j", "--journal", required=False, default=JOURNAL_PATH,
+                        help="File recording recycle progress, {pool} is replaced "
+                             "by the pool name. Defaults to " + JOURNAL_PATH)
+    parser.add_argument("--resume", required=False, action='store_true',
+                        help="Resume a failed recycle from its journal")
     parsed = parser.parse_args(args)
+    template_weights = {}
+    for weight in parsed.template_weight:
+        template, _, value = weight.rpartition("=")
+        try:
+            template_weights[template] = float(value)
+        except ValueError:
+            parser.error("invalid template weight: {}".format(weight))
+    if parsed.look_ahead and parsed.pre_provision:
+        parser.error("--look-ahead and --pre_provision can't be used together")
+    if (parsed.max_surge or parsed.max_unavailable) and (parsed.look_ahead or parsed.pre_provision):
+        parser.error("--max-surge and --max-unavailable can't be used with --look-ahead "
+                     "or --pre_provision")
+    if parsed.max_surge is not None and float(parsed.max_surge.rstrip("%")) == 0 and \
+            (parsed.max_unavailable is None or float(parsed.max_unavailable.rstrip("%")) == 0):
+        parser.error("--max-surge and --max-unavailable can't both be 0")
+    if parsed.daemon and parsed.max_age is None and not parsed.drift:
+        parser.error("--daemon needs --max-age or --drift")
+    if parsed.daemon and (parsed.dry_run or parsed.resume or parsed.pre_provision or
+                          parsed.look_ahead or parsed.max_surge or parsed.max_unavailable or
+                          parsed.disable_old_nodes):
+        parser.error("--daemon can't be used with --dry-run, --resume, --pre_provision, "
+                     "--look-ahead, --max-surge, --max-unavailable or --disable-old-nodes")
+    if parsed.record and parsed.replay:
+        parser.error("--record and --replay can't be used together")
+    if parsed.replay_speed < 0:
+        parser.error("--replay-speed can't be negative")
+    if (parsed.all_pools or len(parsed.pool) > 1) and "{pool}" not in parsed.journal:
+        parser.error("--journal must contain {pool} when recycling several pools")
     pool_recycle(parsed.pool, parsed.dry_run, parsed.max_retry,
-                 parsed.retry_interval)
+                 parsed.retry_interval, parallel=parsed.parallel,
+                 pre_provision=parsed.pre_provision, backoff=parsed.backoff,
+                 deadline=parsed.deadline, journal_path=parsed.journal,
+                 resume=parsed.resume, all_pools=parsed.all_pools,
+                 max_in_flight=parsed.max_in_flight, order=parsed.order,
+                 template_weights=template_weights or None,
+                 metrics_file=parsed.metrics_file, metrics_format=parsed.metrics_format,
+                 http_pool_size=parsed.http_pool_size, slow_start=parsed.slow_start,
+                 read_rate=parsed.read_rate, write_rate=parsed.write_rate,
+                 max_age=parsed.max_age, drift=parsed.drift, only=parsed.only,
+                 exclude=parsed.exclude, look_ahead=parsed.look_ahead,
+                 max_surge=parsed.max_surge, max_unavailable=parsed.max_unavailable,
+                 breaker_threshold=parsed.breaker_threshold,
+                 breaker_cooldown=parsed.breaker_cooldown,
+                 disable_old_nodes=parsed.disable_old_nodes, record=parsed.record,
+                 replay=parsed.replay, replay_speed=parsed.replay_speed, daemon=parsed.daemon,
+                 interval=parsed.interval, queue_size=parsed.queue_size,
+                 windows=parsed.window or None,
+                 include_unknown_age=parsed.include_unknown_age)
 
 
 def main(args=None):
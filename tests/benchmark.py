@@ -0,0 +1,114 @@
+# Copyright 2015 tsuru-pool-recycle-plugin authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+"""Measures pool_recycle wall-clock time and tsuru API calls against FakeTsuru.
+
+Usage:
+
+    make bench BENCH_ARGS="--sizes 10,50 --parallel 1,10 --pre-provision"
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+
+from pool_recycle import plugin
+from tests.fake_tsuru import FakeTsuru
+
+
+def run_benchmark(size, settings, templates=2, containers=10, seed=0, **fake_options):
+    fake = FakeTsuru(seed=seed, **fake_options).start()
+    try:
+        rand = random.Random(seed)
+        for idx in range(templates):
+            fake.add_template("template{}".format(idx), "bench")
+        for idx in range(size):
+            fake.add_node("bench", template="template{}".format(idx % templates),
+                          containers=rand.randint(0, 2 * containers))
+        os.environ["TSURU_TARGET"] = fake.url
+        os.environ["TSURU_TOKEN"] = "benchmark"
+        stdout, stderr = sys.stdout, sys.stderr
+        sys.stdout = sys.stderr = open(os.devnull, "w")
+        start = time.time()
+        failed = False
+        try:
+            plugin.pool_recycle("bench", **settings)
+        except SystemExit:
+            failed = True
+        finally:
+            sys.stdout.close()
+            sys.stdout, sys.stderr = stdout, stderr
+        return {"seconds": time.time() - start, "failed": failed,
+                "calls": fake.call_count(), "connections": fake.connections,
+                "moves": fake.moves,
+                "event_polls": fake.calls.get(("GET", "events"), 0)}
+    finally:
+        fake.stop()
+
+
+def settings_grid(parallels, pre_provision=False, slow_start=False, look_ahead=0,
+                  disable_old_nodes=False):
+    for parallel in parallels:
+        yield "parallel={}".format(parallel), {"parallel": parallel}
+    if slow_start:
+        yield "slow_start", {"slow_start": True, "parallel": max(parallels)}
+    if look_ahead:
+        yield "look_ahead={}".format(look_ahead), {"look_ahead": look_ahead, "parallel": max(parallels)}
+    if pre_provision:
+        yield "pre_provision", {"pre_provision": True, "parallel": max(parallels)}
+    if disable_old_nodes:
+        yield "disable_old_nodes", {"disable_old_nodes": True, "parallel": max(parallels)}
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Benchmark pool recycle against a fake tsuru API")
+    parser.add_argument("--sizes", default="10,50",
+                        help="Comma separated pool sizes")
+    parser.add_argument("--parallel", default="1,10",
+                        help="Comma separated --parallel values")
+    parser.add_argument("--pre-provision", action="store_true",
+                        help="Also benchmark --pre_provision")
+    parser.add_argument("--slow-start", action="store_true",
+                        help="Also benchmark --slow-start")
+    parser.add_argument("--look-ahead", type=int, default=0,
+                        help="Also benchmark --look-ahead with this many nodes")
+    parser.add_argument("--disable-old-nodes", action="store_true",
+                        help="Also benchmark --disable-old-nodes")
+    parser.add_argument("--latency", type=float, default=0.02,
+                        help="Seconds added to every API request")
+    parser.add_argument("--boot-time", type=float, default=3,
+                        help="Seconds a new node takes to boot")
+    parser.add_argument("--remove-time", type=float, default=1,
+                        help="Seconds a node removal takes, before container moves")
+    parser.add_argument("--remove-time-per-container", type=float, default=0.05,
+                        help="Seconds added to a node removal for each container it runs")
+    parser.add_argument("--create-failure-rate", type=float, default=0,
+                        help="Share of node creations that fail")
+    parser.add_argument("--retry-interval", type=int, default=5,
+                        help="--retry-interval given to the plugin")
+    parsed = parser.parse_args(args)
+    sys.stdout.write("{:>6}  {:<17} {:>10} {:>10} {:>12} {:>12} {:>16}  {}\n".format(
+        "nodes", "settings", "seconds", "api calls", "event polls", "connections",
+        "container moves", "result"))
+    for size in [int(size) for size in parsed.sizes.split(",")]:
+        parallels = [int(parallel) for parallel in parsed.parallel.split(",")]
+        grid = settings_grid(parallels, parsed.pre_provision, parsed.slow_start, parsed.look_ahead,
+                             parsed.disable_old_nodes)
+        for name, settings in grid:
+            settings["retry_interval"] = parsed.retry_interval
+            result = run_benchmark(size, settings, latency=parsed.latency,
+                                   boot_time=parsed.boot_time,
+                                   remove_time=parsed.remove_time,
+                                   remove_time_per_container=parsed.remove_time_per_container,
+                                   create_failure_rate=parsed.create_failure_rate)
+            sys.stdout.write("{:>6}  {:<17} {:>10.1f} {:>10} {:>12} {:>12} {:>16}  {}\n".format(
+                size, name, result["seconds"], result["calls"], result["event_polls"],
+                result["connections"], result["moves"], "failed" if result["failed"] else "ok"))
+            sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,309 @@
+# Copyright 2015 tsuru-pool-recycle-plugin authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+"""In-process stand-in for the tsuru API endpoints used by the plugin.
+
+FakeTsuru serves users, nodes, templates, events, healings and node
+containers over HTTP on localhost. Node creations and removals run as
+tsuru events that finish after a configurable boot or removal time, so
+pool_recycle can be exercised end to end under realistic latencies.
+"""
+
+import BaseHTTPServer
+import SocketServer
+import itertools
+import json
+import random
+import socket
+import threading
+import time
+import urllib
+import urlparse
+
+
+def format_time(timestamp):
+    if timestamp is None:
+        return "0001-01-01T00:00:00Z"
+    return time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(timestamp)) + \
+        ".{:06d}Z".format(int(timestamp % 1 * 1000000))
+
+
+class FakeTsuru(object):
+
+    def __init__(self, latency=0, boot_time=0, remove_time=0,
+                 remove_time_per_container=0, create_failure_rate=0,
+                 remove_failure_rate=0, failing_templates=None, seed=None, event_limit=100):
+        self.latency = latency
+        self.boot_time = boot_time
+        self.remove_time = remove_time
+        self.remove_time_per_container = remove_time_per_container
+        self.create_failure_rate = create_failure_rate
+        self.remove_failure_rate = remove_failure_rate
+        self.failing_templates = set(failing_templates or [])
+        self.event_limit = event_limit
+        self.random = random.Random(seed)
+        self.user = "admin@example.com"
+        self.nodes = []
+        self.templates = []
+        self.healings = {}
+        self.events = []
+        self.calls = {}
+        self.moves = 0
+        self.connections = 0
+        self._sockets = []
+        self._addresses = ("http://10.{}.{}.{}:2375".format(a, b, c)
+                           for a, b, c in itertools.product(range(256), repeat=3))
+        self._lock = threading.Lock()
+        self._server = None
+
+    def add_template(self, name, pool, **data):
+        items = [{"Name": "pool", "Value": pool}]
+        items.extend({"Name": key, "Value": value} for key, value in sorted(data.items()))
+        self.templates.append({"Name": name, "IaaSName": "fake", "Data": items})
+
+    def add_node(self, pool, template=None, containers=0):
+        with self._lock:
+            return self._add_node(pool, template, containers)
+
+    def _add_node(self, pool, template=None, containers=0):
+        address = next(self._addresses)
+        metadata = {"pool": pool}
+        if template is not None:
+            metadata["template"] = template
+        self.nodes.append({"Address": address, "Pool": pool, "Metadata": metadata,
+                           "Status": "ready", "Containers": containers})
+        return address
+
+    def pool_nodes(self, pool):
+        with self._lock:
+            self._settle()
+            return [node["Address"] for node in self.nodes if node["Pool"] == pool]
+
+    def call_count(self):
+        with self._lock:
+            return sum(self.calls.values())
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:{}".format(self._server.server_address[1])
+
+    def start(self):
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), FakeTsuruHandler)
+        self._server.fake = self
+        thread = threading.Thread(target=self._server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        # unblock handler threads waiting on keep-alive connections
+        with self._lock:
+            sockets, self._sockets = self._sockets, []
+        for sock in sockets:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+    def _event(self, kind, target, duration, error="", on_finish=None, params=None):
+        now = time.time()
+        event = {"UniqueID": "{:024x}".format(len(self.events) + 1),
+                 "Kind": {"Type": "permission", "Name": kind},
+                 "Owner": {"Type": "user", "Name": self.user},
+                 "Target": {"Type": "node", "Value": target},
+                 "StartTime": format_time(now), "EndTime": format_time(None),
+                 "Running": True, "Error": "",
+                 "StartCustomData": [{"name": name, "value": value}
+                                     for name, value in sorted((params or {}).items())],
+                 "finishes_at": now + duration, "error": error,
+                 "on_finish": on_finish}
+        self.events.append(event)
+        return event
+
+    def _settle(self):
+        now = time.time()
+        for event in self.events:
+            if event["Running"] and event["finishes_at"] <= now:
+                event["Running"] = False
+                event["EndTime"] = format_time(event["finishes_at"])
+                event["Error"] = event["error"]
+                if not event["Error"] and event["on_finish"] is not None:
+                    event["on_finish"](event)
+
+    def _template_data(self, name):
+        for template in self.templates:
+            if template["Name"] == name:
+                return dict((item["Name"], item["Value"]) for item in template["Data"])
+        return None
+
+    def handle(self, method, path, params):
+        """Returns a (status, body) pair for an API request."""
+        parts = [part for part in path.split("/") if part]
+        if parts and parts[0] in ("1.1", "1.2"):
+            parts = parts[1:]
+        if parts[:1] == ["node"]:
+            route = "node"
+        elif parts[:2] == ["docker", "node"]:
+            route = "docker/node/containers"
+        else:
+            route = "/".join(parts)
+        with self._lock:
+            self.calls[(method, route)] = self.calls.get((method, route), 0) + 1
+            self._settle()
+            return self._route(method, parts, path, params)
+
+    def _route(self, method, parts, path, params):
+        if parts == ["users", "info"]:
+            return 200, {"Email": self.user}
+        if parts == ["iaas", "templates"]:
+            return 200, self.templates
+        if parts == ["healing", "node"]:
+            if method == "GET":
+                return 200, self.healings
+            if method == "POST":
+                self.healings[params["pool"]] = {"Enabled": params["Enabled"] == "True"}
+                return 200, None
+            self.healings.pop(params.get("pool"), None)
+            return 200, None
+        if parts == ["events"] and method == "GET":
+            return 200, self._list_events(params)
+        if parts[:1] == ["node"]:
+            if method == "GET":
+                nodes = [dict((key, value) for key, value in node.items() if key != "Containers")
+                         for node in self.nodes]
+                return 200, {"machines": [], "nodes": nodes}
+            if method == "POST":
+                return self._create_node(params)
+            if method == "PUT":
+                return self._update_node(params)
+            if method == "DELETE":
+                return self._remove_node(urllib.unquote(path.split("/node/", 1)[-1]))
+        if parts[:2] == ["docker", "node"] and parts[-1] == "containers":
+            address = urllib.unquote(path.split("/docker/node/", 1)[-1].rsplit("/", 1)[0])
+            for node in self.nodes:
+                if node["Address"] == address:
+                    return 200, [{"ID": "{}-{}".format(address, idx)}
+                                 for idx in range(node["Containers"])] or None
+            return 404, "node not found"
+        return 404, "not found"
+
+    def add_event(self, kind, target, error=""):
+        """Records a finished event, e.g. for nodes of other pools."""
+        with self._lock:
+            self._event(kind, target, 0, error=error)
+            self._settle()
+
+    def _list_events(self, params):
+        fields = {"kindname": ("Kind", "Name"), "ownername": ("Owner", "Name"),
+                  "target.type": ("Target", "Type"), "target.value": ("Target", "Value")}
+        events = []
+        for event in reversed(self.events):
+            if all(event[fields[key][0]][fields[key][1]] == value
+                   for key, value in params.items() if key in fields):
+                events.append(dict((key, value) for key, value in event.items()
+                                   if key[0].isupper()))
+        # like tsuru, a single page of the newest events
+        skip = int(params.get("skip", 0))
+        return events[skip:skip + min(int(params.get("limit", self.event_limit)), self.event_limit)]
+
+    def _create_node(self, params):
+        template = params.get("Metadata.template")
+        data = self._template_data(template)
+        if data is None:
+            return 400, "template not found"
+        pool = data["pool"]
+        error = ""
+        if template in self.failing_templates or \
+                self.random.random() < self.create_failure_rate:
+            error = "IaaS failed to create machine from template {}".format(template)
+
+        metadata = dict(data)
+        metadata.update((name[len("Metadata."):], value) for name, value in params.items()
+                        if name.startswith("Metadata."))
+
+        def finish(event):
+            self.nodes.append({"Address": event["Target"]["Value"], "Pool": pool,
+                               "Metadata": metadata, "Status": "ready", "Containers": 0})
+        self._event("node.create", next(self._addresses), self.boot_time,
+                    error=error, on_finish=finish, params=params)
+        return 200, None
+
+    def _update_node(self, params):
+        node = next((node for node in self.nodes if node["Address"] == params.get("Address")), None)
+        if node is None:
+            return 404, "No such node in storage"
+        if params.get("Disable") == "true":
+            node["Status"] = "disabled"
+        elif params.get("Enable") == "true":
+            node["Status"] = "ready"
+        return 200, None
+
+    def _remove_node(self, address):
+        node = next((node for node in self.nodes if node["Address"] == address), None)
+        if node is None:
+            return 404, "No such node in storage"
+        error = ""
+        if self.random.random() < self.remove_failure_rate:
+            error = "failed to rebalance containers of node {}".format(address)
+        duration = self.remove_time + node["Containers"] * self.remove_time_per_container
+
+        def finish(event):
+            self.nodes.remove(node)
+            # rebalanced containers go to the least loaded enabled nodes of the pool
+            pool_nodes = [other for other in self.nodes if other["Pool"] == node["Pool"] and
+                          other["Status"] != "disabled"]
+            for _ in range(node["Containers"] if pool_nodes else 0):
+                min(pool_nodes, key=lambda other: other["Containers"])["Containers"] += 1
+                self.moves += 1
+        self._event("node.delete", address, duration, error=error, on_finish=finish)
+        return 200, None
+
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class FakeTsuruHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        with self.server.fake._lock:
+            self.server.fake.connections += 1
+            self.server.fake._sockets.append(self.connection)
+
+    def _handle(self, method):
+        url = urlparse.urlparse(self.path)
+        params = dict(urlparse.parse_qsl(url.query))
+        length = int(self.headers.getheader("content-length") or 0)
+        if length:
+            params.update(urlparse.parse_qsl(self.rfile.read(length)))
+        fake = self.server.fake
+        if fake.latency:
+            time.sleep(fake.latency)
+        status, body = fake.handle(method, url.path, params)
+        payload = "" if body is None else json.dumps(body)
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):
+        self._handle("GET")
+
+    def do_POST(self):
+        self._handle("POST")
+
+    def do_DELETE(self):
+        self._handle("DELETE")
+
+    def do_PUT(self):
+        self._handle("PUT")
+
+    def log_message(self, format, *args):
+        pass
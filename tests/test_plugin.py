@@ -3,12 +3,16 @@
 # license that can be found in the LICENSE file.
 
 import os
+import shutil
+import time
+import tempfile
 import unittest
 import json
 
-from mock import patch, Mock, call
+from mock import patch, Mock, call, ANY
 from pool_recycle import plugin
 from pool_recycle.plugin import (RemoveNodeFromPoolError, NewNodeError)
+from tests.fake_tsuru import FakeTsuru
 
 
 class FakeTsuruPool(object):
@@ -26,6 +30,9 @@ class FakeTsuruPool(object):
         self.pre_provision_error = pre_provision_error
         self.call_count = 0
         self.raise_errors_on_call_counter = raise_errors_on_call_counter
+        self.containers = {'127.0.0.1': 12, '10.10.1.1': 3, '10.1.1.2': 7}
+        self.node_templates = {}
+        self.template_health = plugin.TemplateHealth()
 
     def get_machines_templates(self):
         return ['templateA', 'templateB']
@@ -42,7 +49,11 @@ class FakeTsuruPool(object):
         self.call_count += 1
         self.nodes_on_pool.remove(node)
 
-    def create_new_node(self, template):
+    def remove_node(self, node, **kwargs):
+        self.remove_node_from_pool(node)
+        return True
+
+    def create_new_node(self, template, **kwargs):
         if self.pre_provision_error and self.call_count >= self.raise_errors_on_call_counter:
             raise NewNodeError("error adding new node on IaaS")
         new_node = self.new_nodes.pop(0)
@@ -64,12 +75,34 @@ class FakeTsuruPool(object):
     def disable_healing(self):
         return self.disable_healing
 
+    def for_pool(self, pool):
+        return self
+
+    def get_node_templates(self):
+        return dict((node, self.node_templates.get(node)) for node in self.nodes_on_pool)
+
+    def get_operation_durations(self):
+        return {}, [], []
+
+    def prefetch(self, listings, user=False):
+        pass
+
+    def close(self):
+        pass
+
+    def grow_http_pool(self, pool_size):
+        pass
+
+    def get_node_containers(self, node):
+        return [{"ID": str(idx)} for idx in range(self.containers.get(node, 0))]
+
 
 class TsuruPoolTestCase(unittest.TestCase):
 
-    @patch('tsuruclient.users.Manager.info')
-    def setUp(self, users_mock):
-        users_mock.return_value = {"Email": "myuser"}
+    def setUp(self):
+        # the current user is only fetched once an operation needs it
+        self.users_patcher = patch('tsuruclient.users.Manager.info')
+        self.users_patcher.start().return_value = {"Email": "myuser"}
         os.environ["TSURU_TARGET"] = "https://cloud.tsuru.io/"
         os.environ["TSURU_TOKEN"] = "abc123"
         self.patcher = patch('urllib2.urlopen')
@@ -155,12 +188,20 @@ class TsuruPoolTestCase(unittest.TestCase):
 
         docker_nodes_null = '{ "machines": null, "nodes": null }'
         mock.return_value = json.loads(docker_nodes_null)
+        self.pool_handler.snapshot.invalidate()
         self.assertListEqual(self.pool_handler.get_nodes(), [])
 
+    @patch('uuid.uuid4')
     @patch('tsuruclient.nodes.Manager.create')
     @patch('tsuruclient.events.Manager.list')
-    def test_create_new_node(self, mock_list, mock_create):
-        mock_list.return_value = [{"Running": False, "Error": "", "Target": {"Value": "10.2.3.2"}}]
+    def test_create_new_node(self, mock_list, mock_create, uuid4):
+        uuid4.return_value = Mock(hex="req1")
+        mock_list.return_value = [
+            {"Running": True, "Error": "", "Target": {"Value": "10.9.9.9"},
+             "StartCustomData": [{"name": "Metadata.pool-recycle-id", "value": "req2"}]},
+            {"Running": False, "Error": "", "Target": {"Value": "10.2.3.2"},
+             "StartCustomData": [{"name": "Metadata.template", "value": "my_template"},
+                                 {"name": "Metadata.pool-recycle-id", "value": "req1"}]}]
         mock_create.return_value = {}
         self.pool_handler.get_nodes = Mock()
         self.pool_handler.get_nodes.side_effect = [['192.168.1.1',
@@ -171,6 +212,8 @@ class TsuruPoolTestCase(unittest.TestCase):
                                                     'http://10.1.1.1:2723']]
         return_new_node = self.pool_handler.create_new_node("my_template")
         self.assertEqual(return_new_node, '10.2.3.2')
+        mock_create.assert_called_once_with(**{"register": "false", "Metadata.template": "my_template",
+                                               "Metadata.pool-recycle-id": "req1"})
 
     @patch('tsuruclient.templates.Manager.list')
     def test_return_machines_templates(self, mock):
@@ -270,6 +313,7 @@ class TsuruPoolTestCase(unittest.TestCase):
         self.assertListEqual(self.pool_handler.get_machines_templates(),
                              ['template_red', 'template_yellow'])
         mock.side_effect = Exception()
+        self.pool_handler.snapshot.invalidate("templates")
         self.assertRaisesRegexp(Exception, 'Error getting machines templates',
                                 self.pool_handler.get_machines_templates)
 
@@ -285,6 +329,336 @@ class TsuruPoolTestCase(unittest.TestCase):
         self.assertRaisesRegexp(Exception, 'No such node in storage',
                                 self.pool_handler.remove_node, node, 0, 0)
 
+    @patch('tsuruclient.users.Manager.info')
+    @patch('tsuruclient.nodes.Manager.list')
+    def test_cluster_snapshot_is_fetched_once_and_shared(self, mock, users_mock):
+        users_mock.return_value = {"Email": "myuser"}
+        mock.return_value = {"nodes": [{"Address": "http://10.0.0.1:2375", "Pool": "foobar"},
+                                       {"Address": "http://10.0.0.2:2375", "Pool": "bilbo"}]}
+        other_pool = plugin.TsuruPool("bilbo", snapshot=self.pool_handler.snapshot)
+        self.assertEqual(self.pool_handler.get_nodes(), ["http://10.0.0.1:2375"])
+        self.assertEqual(other_pool.get_nodes(), ["http://10.0.0.2:2375"])
+        self.assertEqual(1, mock.call_count)
+
+    @patch('tsuruclient.healings.Manager.list')
+    @patch('tsuruclient.templates.Manager.list')
+    @patch('tsuruclient.nodes.Manager.list')
+    def test_prefetch_fetches_listings_and_user_concurrently(self, nodes, templates, healings):
+        started = []
+        barrier = plugin.threading.Event()
+
+        def slow(result):
+            def fetch(*args):
+                started.append(1)
+                if len(started) == 4:
+                    barrier.set()
+                # each fetch only returns once every fetch has started
+                barrier.wait(1)
+                return result
+            return fetch
+        nodes.side_effect = slow({"nodes": [{"Address": "10.0.0.1", "Pool": "foobar"}]})
+        templates.side_effect = slow([])
+        healings.side_effect = slow({})
+        with patch('tsuruclient.users.Manager.info', side_effect=slow({"Email": "admin"})) as users:
+            self.pool_handler.prefetch(["nodes", "templates", "healings"], user=True)
+            self.assertTrue(barrier.is_set())
+            self.assertEqual(self.pool_handler.get_nodes(), ["10.0.0.1"])
+            self.assertEqual(self.pool_handler.user, {"Email": "admin"})
+            self.assertEqual(self.pool_handler.for_pool("bilbo").user, {"Email": "admin"})
+            self.assertEqual(1, users.call_count)
+        self.assertEqual(1, nodes.call_count)
+
+    @patch('tsuruclient.users.Manager.info')
+    def test_user_is_fetched_on_first_use(self, users):
+        users.side_effect = Exception("unauthorized")
+        pool_handler = plugin.TsuruPool("foobar")
+        self.assertEqual(0, users.call_count)
+        with self.assertRaises(Exception) as error:
+            pool_handler.user
+        self.assertEqual(str(error.exception), "Failed to get current user info: unauthorized")
+
+    @patch('tsuruclient.nodes.Manager.list')
+    def test_cluster_snapshot_ttl(self, mock):
+        mock.return_value = {"nodes": []}
+        snapshot = plugin.ClusterSnapshot(self.pool_handler.client, ttl=60)
+        with patch('time.time') as now:
+            now.return_value = 1000
+            snapshot.nodes("foobar")
+            now.return_value = 1060
+            snapshot.nodes("foobar")
+            self.assertEqual(1, mock.call_count)
+            now.return_value = 1061
+            snapshot.nodes("foobar")
+            self.assertEqual(2, mock.call_count)
+
+    def test_parse_time(self):
+        self.assertEqual(plugin.parse_time("2016-01-01T12:00:00Z"), 1451649600)
+        self.assertEqual(plugin.parse_time("2016-01-01T12:00:00.25Z"), 1451649600.25)
+        self.assertEqual(plugin.parse_time("2016-01-01T10:00:00-02:00"), 1451649600)
+        self.assertRaises(ValueError, plugin.parse_time, "yesterday")
+
+    def test_resolve_capacity(self):
+        self.assertEqual(plugin.resolve_capacity("2", 10), 2)
+        self.assertEqual(plugin.resolve_capacity("25%", 10), 2)
+        self.assertEqual(plugin.resolve_capacity("25%", 10, round_up=True), 3)
+        self.assertIsNone(plugin.resolve_capacity(None, 10))
+        pool_handler = Mock()
+        pool_handler.get_nodes.return_value = ["a"] * 10
+        self.assertEqual(plugin.capacity_limits(pool_handler, max_unavailable="10%"), (1, 1))
+        self.assertEqual(plugin.capacity_limits(pool_handler, "0", "50%"), (0, 5))
+        self.assertRaises(Exception, plugin.capacity_limits, pool_handler, "0", "5%")
+
+    def test_recycle_progress_keeps_cycles_removed_before_replacement(self):
+        start = {"step": "start", "cycles": [["10.0.0.1", "a"], ["10.0.0.2", "b"]]}
+        entries = [{"step": "remove_requested", "node": "10.0.0.1"},
+                   {"step": "removed", "node": "10.0.0.1"},
+                   {"step": "remove_requested", "node": "10.0.0.2"},
+                   {"step": "removed", "node": "10.0.0.2"},
+                   {"step": "create_requested", "node": "10.0.0.2"}]
+        progress = plugin.RecycleProgress(start, entries)
+        self.assertEqual(progress.pending_cycles(["10.0.1.2"]), [("10.0.0.1", "a", None)])
+
+    def test_parse_duration(self):
+        self.assertEqual(plugin.parse_duration("90"), 90)
+        self.assertEqual(plugin.parse_duration("12h"), 43200)
+        self.assertEqual(plugin.parse_duration("7d"), 604800)
+        self.assertRaises(plugin.argparse.ArgumentTypeError, plugin.parse_duration, "soon")
+
+    def test_maintenance_windows(self):
+        night = plugin.parse_window("22:00-06:30")
+        self.assertEqual(night, (1320, 390))
+        self.assertRaises(plugin.argparse.ArgumentTypeError, plugin.parse_window, "22h")
+        # 1970-01-01 23:00 and 12:00 UTC
+        self.assertTrue(plugin.in_windows([night], now=23 * 3600))
+        self.assertFalse(plugin.in_windows([night], now=12 * 3600))
+        self.assertTrue(plugin.in_windows([night, (600, 780)], now=12 * 3600))
+        self.assertTrue(plugin.in_windows(None, now=12 * 3600))
+
+    @patch('tsuruclient.events.Manager.list')
+    @patch('tsuruclient.templates.Manager.list')
+    @patch('tsuruclient.nodes.Manager.list')
+    def test_get_node_ages_and_template_drift(self, nodes, templates, events):
+        nodes.return_value = {"nodes": [
+            {"Address": "10.0.0.1", "Pool": "foobar",
+             "Metadata": {"pool": "foobar", "template": "a", "size": "large"}},
+            {"Address": "10.0.0.2", "Pool": "foobar",
+             "Metadata": {"pool": "foobar", "template": "a", "size": "small"}},
+            {"Address": "10.0.0.3", "Pool": "foobar", "Metadata": {"pool": "foobar", "template": "b"}},
+            {"Address": "10.0.0.4", "Pool": "foobar"}]}
+        templates.return_value = [{"Name": "a", "Data": [{"Name": "pool", "Value": "foobar"},
+                                                         {"Name": "size", "Value": "large"}]}]
+        history = [
+            {"Target": {"Value": "10.0.0.1"}, "StartTime": "2016-01-01T11:00:00Z",
+             "Running": False, "Error": ""},
+            {"Target": {"Value": "10.0.0.2"}, "StartTime": "2015-12-01T12:00:00Z",
+             "Running": False, "Error": ""},
+            {"Target": {"Value": "10.0.0.3"}, "StartTime": "2016-01-01T11:00:00Z",
+             "Running": False, "Error": "IaaS failed"}]
+        events.side_effect = lambda **query: [event for event in history
+                                              if event["Target"]["Value"] == query["target.value"]]
+        with patch('time.time') as now:
+            now.return_value = 1451649600
+            self.assertEqual(self.pool_handler.get_node_ages(),
+                             {"10.0.0.1": 3600, "10.0.0.2": 31 * 86400, "10.0.0.3": None,
+                              "10.0.0.4": None})
+        self.assertItemsEqual(events.call_args_list,
+                              [call(**{"kindname": "node.create", "target.value": "10.0.0.{}".format(idx)})
+                               for idx in range(1, 5)])
+        self.assertEqual(self.pool_handler.get_template_drift(),
+                         {"10.0.0.2": 'template "a" changed size',
+                          "10.0.0.3": 'template "b" no longer exists',
+                          "10.0.0.4": "no template metadata"})
+
+    @patch("sys.stdout")
+    def test_node_selector_picks_old_and_drifted_nodes(self, stdout):
+        pool_handler = Mock()
+        pool_handler.get_node_ages.return_value = {"a": 100, "b": 10 * 86400, "c": None, "d": 100}
+        pool_handler.get_template_drift.return_value = {"d": "no template metadata"}
+        nodes = ["a", "b", "c", "d"]
+        selector = plugin.NodeSelector(max_age=86400, drift=True)
+        self.assertEqual(selector.select(pool_handler, nodes),
+                         (["b", "c", "d"], {"b": "10 days old", "c": "age unknown",
+                                            "d": "no template metadata"}))
+        selector = plugin.NodeSelector(max_age=86400, exclude=["c"])
+        self.assertEqual(selector.select(pool_handler, nodes)[0], ["b"])
+        selector = plugin.NodeSelector(max_age=86400, unknown_age=False)
+        self.assertEqual(selector.select(pool_handler, nodes)[0], ["b"])
+        self.assertEqual(plugin.NodeSelector(only=["a", "d"]).select(pool_handler, nodes),
+                         (["a", "d"], {}))
+
+    @patch("sys.stdout")
+    @patch('pool_recycle.plugin.TsuruPool')
+    def test_pool_recycle_dry_mode_with_selected_nodes(self, tsuru_pool_mock, stdout):
+        fake_pool = FakeTsuruPool('foobar')
+        fake_pool.node_templates = {'127.0.0.1': 'templateA', '10.10.1.1': 'templateA',
+                                    '10.1.1.2': 'templateB'}
+        tsuru_pool_mock.return_value = fake_pool
+        plugin.pool_recycle('foobar', True, exclude=['127.0.0.1'])
+        stdout.write.assert_any_call('Selected 2 of 3 node(s) on pool "foobar".\n')
+        # the kept templateA node makes both replacements use the other templates first
+        stdout.write.assert_any_call('(1/2) Creating new node on pool "foobar" using "templateB" template\n')
+        stdout.write.assert_any_call('(2/2) Creating new node on pool "foobar" using "templateA" template\n')
+        self.assertNotIn(call('(1/3) Removing node "127.0.0.1" from pool "foobar"\n'),
+                         stdout.write.call_args_list)
+
+    def test_estimate_recycle_by_mode_and_concurrency(self):
+        cycles = [plugin.RecycleCycle(idx, "10.0.0.{}".format(idx), template)
+                  for idx, template in enumerate(["a", "b", "a", "b", "a"])]
+        create_seconds = {"a": 300, "b": 500}
+        total, critical = plugin.estimate_recycle(cycles, create_seconds, 100, parallel=1)
+        self.assertEqual(total, 2400)
+        self.assertEqual(len(critical), 10)
+        total, critical = plugin.estimate_recycle(cycles, create_seconds, 100, parallel=2)
+        self.assertEqual(total, 1200)
+        self.assertEqual([(step, cycle.node) for step, cycle, _ in critical],
+                         [("create", "10.0.0.1"), ("remove", "10.0.0.1"),
+                          ("create", "10.0.0.3"), ("remove", "10.0.0.3")])
+        total, critical = plugin.estimate_recycle(cycles, create_seconds, 100, parallel=2,
+                                                  pre_provision=True)
+        self.assertEqual(total, 800)
+        self.assertEqual([(step, cycle.node) for step, cycle, _ in critical],
+                         [("create", "10.0.0.1"), ("remove", "10.0.0.0"),
+                          ("remove", "10.0.0.2"), ("remove", "10.0.0.4")])
+        self.assertEqual(plugin.estimate_recycle([], create_seconds, 100), (0, []))
+        # the next replacement boots while the previous node drains
+        total, critical = plugin.estimate_recycle(cycles, create_seconds, 100, look_ahead=1)
+        self.assertEqual(total, 1300)
+        self.assertEqual([(step, cycle.node) for step, cycle, _ in critical],
+                         [("create", "10.0.0.1"), ("remove", "10.0.0.1"), ("create", "10.0.0.3"),
+                          ("remove", "10.0.0.3"), ("remove", "10.0.0.4")])
+
+    @patch('tsuruclient.events.Manager.list')
+    @patch('tsuruclient.nodes.Manager.list')
+    def test_get_operation_durations(self, nodes, events):
+        nodes.return_value = {"nodes": [
+            {"Address": "10.0.0.1", "Pool": "foobar", "Metadata": {"template": "a"}},
+            {"Address": "10.0.0.2", "Pool": "other", "Metadata": {"template": "b"}}]}
+
+        def list_events(kindname):
+            return [{"Target": {"Value": "10.0.0.{}".format(idx)}, "Running": False, "Error": "",
+                     "StartTime": "2016-01-01T12:00:00Z",
+                     "EndTime": "2016-01-01T12:0{}:00Z".format(idx + (kindname == "node.delete"))}
+                    for idx in [1, 2]]
+        events.side_effect = list_events
+        by_template, creations, removals = self.pool_handler.get_operation_durations()
+        self.assertEqual(by_template, {"a": [60]})
+        self.assertEqual(sorted(creations), [60, 120])
+        self.assertEqual(sorted(removals), [120, 180])
+
+    def test_event_watcher_routes_one_poll_to_many_waiters(self):
+        client = Mock()
+        client.events.list.return_value = [
+            {"Kind": {"Name": "node.delete"}, "Target": {"Type": "node", "Value": "10.0.0.2"},
+             "Running": False, "Error": ""},
+            {"Kind": {"Name": "node.delete"}, "Target": {"Type": "node", "Value": "10.0.0.1"},
+             "Running": True, "Error": ""},
+        ]
+        watcher = plugin.EventWatcher(client, backoff=plugin.ConstantBackoff(0))
+        first = plugin.PendingEvent("Node delete", {"kindname": "node.delete", "target.value": "10.0.0.1"})
+        second = plugin.PendingEvent("Node delete", {"kindname": "node.delete", "target.value": "10.0.0.2"})
+        with patch('sys.stdout'):
+            watcher.tick([first, second])
+        client.events.list.assert_called_once_with(kindname="node.delete")
+        self.assertFalse(first.done)
+        self.assertEqual(second.result()["Target"]["Value"], "10.0.0.2")
+
+    def test_event_watcher_polls_each_kind_of_event_on_its_own(self):
+        client = Mock()
+        client.events.list.side_effect = lambda **query: [
+            {"Kind": {"Name": query["kindname"]}, "Target": {"Type": "node", "Value": "10.0.0.1"},
+             "Running": False, "Error": ""}]
+        watcher = plugin.EventWatcher(client, backoff=plugin.ConstantBackoff(0))
+        create = plugin.PendingEvent("Node create", {"kindname": "node.create", "target.value": "10.0.0.1"})
+        delete = plugin.PendingEvent("Node delete", {"kindname": "node.delete", "target.value": "10.0.0.1"})
+        watcher.tick([create, delete])
+        self.assertEqual(client.events.list.call_args_list,
+                         [call(kindname="node.create", **{"target.value": "10.0.0.1"}),
+                          call(kindname="node.delete", **{"target.value": "10.0.0.1"})])
+        self.assertEqual(create.result()["Kind"]["Name"], "node.create")
+        self.assertEqual(delete.result()["Kind"]["Name"], "node.delete")
+
+    def test_event_watcher_polls_until_event_finishes(self):
+        client = Mock()
+        client.events.list.side_effect = [[{"Running": True, "Error": ""}],
+                                          [{"Running": False, "Error": "", "Target": {"Value": "10.0.0.3"}}]]
+        watcher = plugin.EventWatcher(client, backoff=plugin.ConstantBackoff(0))
+        with patch('sys.stdout'):
+            event = watcher.wait("Node create", kindname="node.create")
+        self.assertEqual(event["Target"]["Value"], "10.0.0.3")
+        self.assertEqual(2, client.events.list.call_count)
+
+    @patch('sys.stderr')
+    def test_event_watcher_gives_up_after_max_retry(self, stderr):
+        client = Mock()
+        client.events.list.side_effect = Exception("tsuru is down")
+        watcher = plugin.EventWatcher(client, backoff=plugin.ConstantBackoff(0))
+        self.assertRaisesRegexp(Exception, "tsuru is down", watcher.wait,
+                                "Node create", max_retry=1, kindname="node.create")
+        self.assertEqual(2, client.events.list.call_count)
+
+    def test_event_watcher_deadline(self):
+        client = Mock()
+        client.events.list.return_value = [{"Running": True, "Error": ""}]
+        watcher = plugin.EventWatcher(client, backoff=plugin.ConstantBackoff(0.01))
+        with patch('sys.stdout'):
+            self.assertRaisesRegexp(plugin.DeadlineExceeded,
+                                    "Node delete did not finish within 0.05 seconds",
+                                    watcher.wait, "Node delete", deadline=plugin.Deadline(0.05),
+                                    kindname="node.delete")
+
+    @patch('random.uniform')
+    def test_exponential_backoff_grows_up_to_interval(self, uniform):
+        uniform.side_effect = lambda low, high: high
+        delays = plugin.ExponentialBackoff(15).delays()
+        self.assertEqual([next(delays) for _ in range(6)], [1, 2, 4, 8, 15, 15])
+        uniform.side_effect = lambda low, high: low
+        delays = plugin.ExponentialBackoff(15, jitter=0.5).delays()
+        self.assertEqual(next(delays), 0.5)
+
+    @patch('time.sleep')
+    @patch('sys.stderr')
+    @patch('tsuruclient.events.Manager.list')
+    @patch('tsuruclient.nodes.Manager.remove')
+    def test_remove_node_retries_with_backoff(self, mock_delete, mock_events, stderr, sleep):
+        mock_events.return_value = [{"Running": False, "Error": ""}]
+        mock_delete.side_effect = [Exception("tsuru is busy"), {}]
+        self.pool_handler.backoff = plugin.ConstantBackoff
+        self.assertTrue(self.pool_handler.remove_node('10.0.0.1', retry_interval=7))
+        sleep.assert_called_once_with(7)
+        stderr.write.assert_called_once_with("Node delete failed: tsuru is busy. Retrying in 7 seconds.\n")
+
+    @patch('time.sleep')
+    @patch('sys.stderr')
+    @patch('tsuruclient.nodes.Manager.create')
+    def test_create_new_node_deadline(self, mock_create, stderr, sleep):
+        mock_create.side_effect = Exception("quota exceeded")
+        self.pool_handler.deadline = 30
+        self.pool_handler.backoff = plugin.ConstantBackoff
+        self.assertRaisesRegexp(NewNodeError, "Deadline exceeded: quota exceeded",
+                                self.pool_handler.create_new_node, "my_template",
+                                retry_interval=60)
+        self.assertEqual(0, sleep.call_count)
+
+    @patch('sys.stdout')
+    @patch('tsuruclient.nodes.Manager.update')
+    @patch('tsuruclient.nodes.Manager.list')
+    def test_disable_nodes_enables_nodes_left_after(self, mock_list, mock_update, stdout):
+        mock_list.return_value = {"nodes": [
+            {"Address": "10.0.0.1", "Pool": "foobar", "Status": "ready"},
+            {"Address": "10.0.0.2", "Pool": "foobar", "Status": "disabled"},
+            {"Address": "10.0.0.3", "Pool": "foobar", "Status": "ready"}]}
+        enable = self.pool_handler.disable_nodes(["10.0.0.1", "10.0.0.2", "10.0.0.3"])
+        self.assertEqual(mock_update.call_args_list,
+                         [call("10.0.0.1", Address="10.0.0.1", Disable="true"),
+                          call("10.0.0.3", Address="10.0.0.3", Disable="true")])
+        mock_update.reset_mock()
+        mock_list.return_value = {"nodes": [{"Address": "10.0.0.2", "Pool": "foobar"},
+                                            {"Address": "10.0.0.3", "Pool": "foobar"}]}
+        enable()
+        self.assertEqual(mock_update.call_args_list,
+                         [call("10.0.0.3", Address="10.0.0.3", Enable="true")])
+        stdout.write.assert_any_call("Re-enabling 1 node(s) left in pool.\n")
+
     @patch('tsuruclient.healings.Manager.remove')
     @patch('tsuruclient.healings.Manager.update')
     @patch('tsuruclient.healings.Manager.list')
@@ -316,14 +690,20 @@ class TsuruPoolTestCase(unittest.TestCase):
                                                            pool="foobar")])
 
     @patch("sys.stdout")
+    @patch('pool_recycle.plugin.TsuruPool.prefetch')
+    @patch('pool_recycle.plugin.TsuruPool.get_operation_durations')
+    @patch('pool_recycle.plugin.TsuruPool.get_node_templates')
     @patch('pool_recycle.plugin.TsuruPool.get_nodes')
     @patch('pool_recycle.plugin.TsuruPool.get_machines_templates')
     @patch('pool_recycle.plugin.TsuruPool.disable_healing')
     @patch('tsuruclient.users.Manager.info')
     def test_pool_recycle_on_dry_mode(self, users, disable_healing,
                                       get_machines_templates, get_nodes,
-                                      stdout):
+                                      get_node_templates, get_operation_durations, prefetch, stdout):
         users.return_value = {"Email": "myuser"}
+        get_node_templates.return_value = {}
+        get_operation_durations.return_value = ({"templateA": [600], "templateB": [300]},
+                                                [600, 300, 450], [120, 180])
         disable_healing.return_value = disable_healing
         get_machines_templates.return_value = ['templateA', 'templateB', 'templateC']
         get_nodes.return_value = ['http://127.0.0.1:4243', '10.10.2.2',
@@ -342,10 +722,21 @@ class TsuruPoolTestCase(unittest.TestCase):
                             call('(4/4) Creating new node on pool "foobar" using "templateA" template\n'),
                             call('Destroying node "http://2.3.2.1:2123\n'),
                             call('\n'),
+                            call('Estimated duration of pool "foobar": 40m30s for 4 node(s), 1 at a time.\n'),
+                            call('  typical node create: 10m00s "templateA", 5m00s "templateB", '
+                                 '7m30s "templateC"; node remove: 2m00s\n'),
+                            call('  critical path: create http://127.0.0.1:4243 (10m00s) -> '
+                                 'remove http://127.0.0.1:4243 (2m00s) -> create 10.10.2.2 (5m00s) -> '
+                                 'remove 10.10.2.2 (2m00s) -> create 10.2.3.2 (7m30s) -> '
+                                 'remove 10.2.3.2 (2m00s) -> create http://2.3.2.1:2123 (10m00s) -> '
+                                 'remove http://2.3.2.1:2123 (2m00s)\n'),
                             call('Done.\n')]
 
         self.assertEqual(stdout.write.call_args_list, call_stdout_list)
         self.assertEqual(2, disable_healing.call_count)
+        prefetch.assert_called_once_with(["templates", "nodes", "healings", "creations", "removals"],
+                                         user=False)
+        self.assertEqual(0, users.call_count)
 
     @patch("sys.stdout")
     @patch('pool_recycle.plugin.TsuruPool')
@@ -370,7 +761,861 @@ class TsuruPoolTestCase(unittest.TestCase):
     def test_pool_recycle_parser_with_all_options_set(self, pool_recycle, stdout, stderr):
         args = ["-p", "foobar", "-d", "-m", "100", "-i", "30"]
         plugin.pool_recycle_parser(args)
-        pool_recycle.assert_called_once_with('foobar', True, 100, 30)
+        pool_recycle.assert_called_once_with(['foobar'], True, 100, 30, parallel=1,
+                                             pre_provision=False, backoff="exponential",
+                                             deadline=None, journal_path=plugin.JOURNAL_PATH,
+                                             resume=False, all_pools=False, max_in_flight=None,
+                                             order="api", template_weights=None,
+                                             metrics_file=None, metrics_format="json",
+                                             http_pool_size=None, slow_start=False,
+                                             read_rate=None, write_rate=None, max_age=None,
+                                             drift=False, only=None, exclude=None,
+                                             look_ahead=0, max_surge=None, max_unavailable=None,
+                                             breaker_threshold=3, breaker_cooldown=300,
+                                             disable_old_nodes=False, record=None, replay=None,
+                                             replay_speed=1, daemon=False, interval=300,
+                                             queue_size=10, windows=None,
+                                             include_unknown_age=False)
+
+    @patch("sys.stdout")
+    @patch('pool_recycle.plugin.TsuruPool')
+    def test_pool_recycle_dry_mode_ordered_by_containers(self, tsuru_pool_mock, stdout):
+        tsuru_pool_mock.return_value = FakeTsuruPool('foobar')
+        plugin.pool_recycle('foobar', True, order="least-loaded")
+        call_stdout_list = [call('Going to recycle 3 node(s) from pool "foobar" using 2 templates.\n'),
+                            call('Nodes ordered by "least-loaded", about 22 container move(s) expected.\n'),
+                            call('(1/3) Creating new node on pool "foobar" using "templateA" template\n'),
+                            call('Destroying node "10.10.1.1" with 3 container(s)\n'),
+                            call('\n'),
+                            call('(2/3) Creating new node on pool "foobar" using "templateB" template\n'),
+                            call('Destroying node "10.1.1.2" with 7 container(s)\n'),
+                            call('\n'),
+                            call('(3/3) Creating new node on pool "foobar" using "templateA" template\n'),
+                            call('Destroying node "127.0.0.1" with 12 container(s)\n'),
+                            call('\n'),
+                            call('Not enough node.create and node.delete history to estimate '
+                                 'the duration of pool "foobar".\n'),
+                            call('Done.\n')]
+        self.assertEqual(stdout.write.call_args_list, call_stdout_list)
+
+    def test_metrics_summary_and_files(self):
+        metrics = plugin.RecycleMetrics()
+        for seconds in [1, 2, 3, 4, 10]:
+            metrics.observe("phase", "create", seconds)
+        metrics.observe("api", "nodes.create", 0.25)
+        metrics.increment("create", "retries", 2)
+        metrics.increment("remove", "retries")
+        metrics.set("daemon", "queue_depth", 3)
+        self.assertEqual(plugin.percentile(metrics.durations("phase", "create"), 50), 3)
+        self.assertEqual(metrics.summary(),
+                         ["  api    nodes.create         count=1 p50=0.25 p90=0.25 p99=0.25 "
+                          "max=0.25 total=0.25",
+                          "  phase  create               count=5 p50=3 p90=10 p99=10 max=10 total=20",
+                          "  create retries              2",
+                          "  daemon queue_depth          3",
+                          "  remove retries              1"])
+        metrics_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, metrics_dir)
+        prom_path = os.path.join(metrics_dir, "recycle.prom")
+        metrics.write(prom_path, "prometheus")
+        with open(prom_path) as prom_file:
+            prom = prom_file.read()
+        self.assertIn('pool_recycle_phase_duration_seconds{phase="create",quantile="0.9"} 10\n', prom)
+        self.assertIn('pool_recycle_phase_duration_seconds_count{phase="create"} 5\n', prom)
+        self.assertIn('pool_recycle_api_duration_seconds_sum{api="nodes.create"} 0.25\n', prom)
+        self.assertIn('# TYPE pool_recycle_retries_total counter\n'
+                      'pool_recycle_retries_total{family="create"} 2\n'
+                      'pool_recycle_retries_total{family="remove"} 1\n', prom)
+        self.assertIn('# TYPE pool_recycle_queue_depth gauge\n'
+                      'pool_recycle_queue_depth{family="daemon"} 3\n', prom)
+        self.assertEqual(prom.count("# TYPE pool_recycle_retries_total "), 1)
+        json_path = os.path.join(metrics_dir, "recycle.json")
+        metrics.write(json_path)
+        with open(json_path) as json_file:
+            lines = [json.loads(line) for line in json_file]
+        self.assertEqual(9, len(lines))
+        self.assertEqual({"counter": "retries", "family": "create", "value": 2}, lines[-3])
+        self.assertEqual({"gauge": "queue_depth", "family": "daemon", "value": 3}, lines[-1])
+
+    @patch('tsuruclient.nodes.Manager.remove')
+    @patch('tsuruclient.events.Manager.list')
+    def test_remove_node_is_timed(self, mock_events, mock_remove):
+        mock_events.return_value = [{"Running": False, "Error": ""}]
+        self.pool_handler.remove_node('10.0.0.1')
+        metrics = self.pool_handler.metrics
+        self.assertEqual(1, len(metrics.durations("phase", "remove")))
+        self.assertEqual(1, len(metrics.durations("phase", "event_wait")))
+        self.assertEqual(1, len(metrics.durations("api", "nodes.remove")))
+        self.assertEqual(1, len(metrics.durations("api", "events.list")))
+
+    def test_template_planner_round_robin_by_default(self):
+        planner = plugin.TemplatePlanner(['a', 'b', 'c'])
+        self.assertEqual(planner.assign(5), ['a', 'b', 'c', 'a', 'b'])
+
+    def test_template_planner_balances_kept_nodes_and_weights(self):
+        planner = plugin.TemplatePlanner(['a', 'b'], weights={'a': 3, 'b': 1}, kept={'b': 2})
+        self.assertItemsEqual(planner.assign(6), ['a'] * 6)
+        planner = plugin.TemplatePlanner(['a', 'b'], weights={'a': 2, 'b': 1})
+        self.assertEqual(planner.assign(6), ['a', 'b', 'a', 'a', 'b', 'a'])
+        self.assertEqual(planner.distribution(), [('a', 4), ('b', 2)])
+        self.assertRaisesRegexp(Exception, "Templates not associated with the pool: z",
+                                plugin.TemplatePlanner, ['a'], weights={'z': 1})
+
+    def test_template_planner_skips_unhealthy_templates(self):
+        health = plugin.TemplateHealth(threshold=1)
+        planner = plugin.TemplatePlanner(['a', 'b', 'c'], health=health)
+        health.failed('b')
+        self.assertEqual(planner.assign(2), ['a', 'c'])
+        self.assertEqual(planner.reassign('c'), 'c')
+        health.failed('c')
+        self.assertEqual(planner.reassign('c'), 'a')
+        health.failed('a')
+        # with every template failing, nodes stay where they are
+        self.assertEqual(planner.reassign('a'), 'a')
+        self.assertEqual(len(planner.assign(3)), 3)
+        self.assertRaisesRegexp(NewNodeError, "No template with a positive weight",
+                                plugin.TemplatePlanner(['a'], weights={'a': 0}).assign, 1)
+
+    @patch('time.time')
+    def test_template_health_breaker_half_opens_after_cooldown(self, now):
+        now.return_value = 1000
+        health = plugin.TemplateHealth(threshold=2, cooldown=60)
+        self.assertFalse(health.failed('a'))
+        self.assertEqual(health.state('a'), "closed")
+        self.assertTrue(health.failed('a'))
+        self.assertFalse(health.is_healthy('a'))
+        now.return_value = 1060
+        self.assertEqual(health.state('a'), "half-open")
+        self.assertTrue(health.is_healthy('a'))
+        health.attempt('a')
+        self.assertFalse(health.is_healthy('a'))
+        self.assertTrue(health.failed('a'))
+        self.assertEqual(health.state('a'), "open")
+        now.return_value = 1120
+        health.attempt('a')
+        health.succeeded('a')
+        self.assertEqual(health.state('a'), "closed")
+        self.assertTrue(health.is_healthy('a'))
+
+    @patch('uuid.uuid4')
+    @patch('time.sleep')
+    @patch('sys.stderr')
+    @patch('tsuruclient.events.Manager.list')
+    @patch('tsuruclient.nodes.Manager.create')
+    def test_create_new_node_fails_over_to_healthy_template(self, mock_create, mock_list, stderr, sleep,
+                                                            uuid4):
+        uuid4.return_value = Mock(hex="req1")
+        mock_create.side_effect = [Exception("quota exceeded"), {}]
+        mock_list.return_value = [{"Running": False, "Error": "", "Target": {"Value": "10.2.3.2"},
+                                   "StartCustomData": [{"name": "Metadata.pool-recycle-id",
+                                                        "value": "req1"}]}]
+        self.pool_handler.get_nodes = Mock(return_value=['10.2.3.2'])
+        self.pool_handler.template_health = plugin.TemplateHealth(threshold=1)
+        planner = plugin.TemplatePlanner(['a', 'b'], health=self.pool_handler.template_health)
+        failover = Mock()
+        self.assertEqual(self.pool_handler.create_new_node('a', planner=planner,
+                                                           on_failover=failover), '10.2.3.2')
+        failover.assert_called_once_with('b')
+        self.assertEqual(mock_create.call_args[1]['Metadata.template'], 'b')
+        self.assertEqual(0, sleep.call_count)
+        self.assertEqual(self.pool_handler.metrics.counter("create", "failovers"), 1)
+        self.assertEqual(self.pool_handler.metrics.counter("create", "breaker_opens"), 1)
+
+    @patch('uuid.uuid4')
+    @patch('time.sleep')
+    @patch('sys.stderr')
+    @patch('tsuruclient.events.Manager.list')
+    @patch('tsuruclient.nodes.Manager.create')
+    def test_create_new_node_retries_when_no_other_template_is_healthy(self, mock_create, mock_list,
+                                                                       stderr, sleep, uuid4):
+        uuid4.return_value = Mock(hex="req1")
+        mock_create.side_effect = [Exception("quota exceeded")] * 4 + [{}]
+        mock_list.return_value = [{"Running": False, "Error": "", "Target": {"Value": "10.2.3.2"},
+                                   "StartCustomData": [{"name": "Metadata.pool-recycle-id",
+                                                        "value": "req1"}]}]
+        self.pool_handler.get_nodes = Mock(return_value=['10.2.3.2'])
+        self.pool_handler.backoff = plugin.ConstantBackoff
+        planner = plugin.TemplatePlanner(['a'], health=self.pool_handler.template_health)
+        failover = Mock()
+        self.assertEqual(self.pool_handler.create_new_node('a', planner=planner, retry_interval=5,
+                                                           on_failover=failover), '10.2.3.2')
+        self.assertEqual(sleep.call_args_list, [call(5)] * 4)
+        self.assertEqual(0, failover.call_count)
+        self.assertEqual(self.pool_handler.metrics.counter("create", "breaker_opens"), 1)
+        mock_create.side_effect = Exception("quota exceeded")
+        self.assertRaisesRegexp(NewNodeError, "Maximum number of retries exceeded: quota exceeded",
+                                self.pool_handler.create_new_node, 'a', planner=planner,
+                                max_retry=2)
+
+    @patch("sys.stdout")
+    def test_run_recycle_passes_max_retry_to_creations(self, stdout):
+        for mode in [{}, {"look_ahead": 1}, {"pre_provision": True},
+                     {"max_surge": 1, "max_unavailable": 0}]:
+            fake_pool = FakeTsuruPool('foobar')
+            create_new_node = Mock(side_effect=fake_pool.create_new_node)
+            fake_pool.create_new_node = create_new_node
+            cycles = [plugin.RecycleCycle(idx, node, 'templateA')
+                      for idx, node in enumerate(list(fake_pool.nodes_on_pool))]
+            plugin.run_recycle(fake_pool, cycles, plugin.RecycleJournal(None), max_retry=3,
+                               retry_interval=1, **mode)
+            self.assertEqual(create_new_node.call_count, 3)
+            for _, kwargs in create_new_node.call_args_list:
+                self.assertEqual(kwargs["max_retry"], 3)
+
+    def test_daemon_disables_healing_without_holding_its_lock(self):
+        handler = Mock(pool="foobar")
+        entered, answer = plugin.threading.Event(), plugin.threading.Event()
+        enable = Mock()
+
+        def disable_healing():
+            entered.set()
+            answer.wait(5)
+            return enable
+        handler.disable_healing.side_effect = disable_healing
+        daemon = plugin.RecycleDaemon([handler], plugin.NodeSelector(max_age=1))
+        holders = [plugin.threading.Thread(target=daemon.hold_healing, args=(handler,))
+                   for _ in range(2)]
+        for holder in holders:
+            holder.start()
+        entered.wait(5)
+        # tsuru is still answering, yet the daemon state stays available
+        self.assertTrue(daemon._lock.acquire(False))
+        daemon._lock.release()
+        answer.set()
+        for holder in holders:
+            holder.join(5)
+        self.assertEqual(handler.disable_healing.call_count, 1)
+        daemon.release_healing(handler)
+        self.assertFalse(enable.called)
+        daemon.release_healing(handler)
+        enable.assert_called_once_with()
+
+    @patch("sys.stdout")
+    def test_provision_node_keeps_failing_template_without_healthy_one(self, stdout):
+        fake_pool = FakeTsuruPool('foobar')
+        health = plugin.TemplateHealth(threshold=1)
+        planner = plugin.TemplatePlanner(['templateA'], health=health)
+        health.failed('templateA')
+        cycle = plugin.RecycleCycle(0, '10.10.1.1', 'templateA')
+        plugin.provision_node(fake_pool, cycle, '(1/1)', plugin.RecycleJournal(None), planner=planner)
+        self.assertEqual(cycle.template, 'templateA')
+        self.assertIsNotNone(cycle.new_node)
+
+    @patch("sys.stdout")
+    @patch('pool_recycle.plugin.TsuruPool')
+    def test_pool_recycle_dry_mode_with_template_weights(self, tsuru_pool_mock, stdout):
+        fake_pool = FakeTsuruPool('foobar')
+        fake_pool.nodes_on_pool.append('10.9.9.9')
+        fake_pool.node_templates = {'10.9.9.9': 'templateB'}
+        tsuru_pool_mock.return_value = fake_pool
+        plugin.pool_recycle(['foobar'], True, template_weights={'templateA': 1, 'templateB': 1})
+        stdout.write.assert_any_call('Planned template distribution: templateA=2, templateB=2\n')
+
+    def test_order_nodes(self):
+        loads = [('a', 10), ('b', 1), ('c', 5), ('d', 20)]
+        self.assertEqual(plugin.order_nodes(loads, "most-loaded")[0], ['d', 'a', 'c', 'b'])
+        nodes, moves = plugin.order_nodes(loads, "api")
+        self.assertEqual(nodes, ['a', 'b', 'c', 'd'])
+        self.assertGreater(moves, 36)
+        self.assertEqual(plugin.order_nodes(loads, "min-migration"), (['b', 'c', 'a', 'd'], 36))
+
+    def test_migration_model_spills_match_spread(self):
+        for pre_provisioned in [False, True]:
+            model = plugin.MigrationModel([('a', 10), ('b', 1), ('c', 5), ('d', 20), ('e', 5)],
+                                          pre_provisioned)
+            model.remove('c')
+            spills = model.spills()
+            self.assertEqual(sorted(spills), ['a', 'b', 'd', 'e'])
+            for node, spilled in spills.items():
+                self.assertAlmostEqual(spilled, model.spread(node)[1])
+
+    def test_water_level(self):
+        self.assertEqual(plugin.water_level([0, 5, 10], 7), 6)
+        self.assertEqual(plugin.water_level([0, 5, 10], 3), 3)
+        self.assertEqual(plugin.water_level([2, 2], 20), 12)
+
+    @patch('pool_recycle.plugin.SessionTransport.request')
+    def test_get_node_containers(self, request):
+        request.return_value = [{"ID": "abc"}, {"ID": "def"}]
+        self.assertEqual(2, len(self.pool_handler.get_node_containers("http://10.0.0.1:2375")))
+        request.assert_called_once_with(ANY, "get", "/docker/node/http%3A%2F%2F10.0.0.1%3A2375/containers")
+        request.return_value = {}
+        self.assertEqual([], self.pool_handler.get_node_containers("10.0.0.1"))
+
+    @patch('sys.stderr')
+    @patch('sys.stdout')
+    @patch('pool_recycle.plugin.pool_recycle')
+    def test_pool_recycle_parser_with_parallel(self, pool_recycle, stdout, stderr):
+        plugin.pool_recycle_parser(["-p", "foobar", "-n", "4"])
+        self.assertEqual(4, pool_recycle.call_args[1]["parallel"])
+
+    @patch('sys.stderr')
+    @patch('sys.stdout')
+    @patch('pool_recycle.plugin.pool_recycle')
+    def test_pool_recycle_parser_with_slow_start(self, pool_recycle, stdout, stderr):
+        plugin.pool_recycle_parser(["-p", "foobar", "-n", "8", "--slow-start"])
+        self.assertTrue(pool_recycle.call_args[1]["slow_start"])
+
+    @patch('sys.stderr')
+    @patch('sys.stdout')
+    @patch('pool_recycle.plugin.pool_recycle')
+    def test_pool_recycle_parser_with_rate_limits(self, pool_recycle, stdout, stderr):
+        plugin.pool_recycle_parser(["-p", "foobar", "--read-rate", "20", "--write-rate", "0.5"])
+        self.assertEqual(20, pool_recycle.call_args[1]["read_rate"])
+        self.assertEqual(0.5, pool_recycle.call_args[1]["write_rate"])
+
+    @patch('sys.stderr')
+    @patch('sys.stdout')
+    @patch('pool_recycle.plugin.pool_recycle')
+    def test_pool_recycle_parser_with_node_selection(self, pool_recycle, stdout, stderr):
+        plugin.pool_recycle_parser(["-p", "foobar", "--max-age", "7d", "--drift",
+                                    "--exclude", "10.0.0.1", "10.0.0.2"])
+        self.assertEqual(604800, pool_recycle.call_args[1]["max_age"])
+        self.assertTrue(pool_recycle.call_args[1]["drift"])
+        self.assertEqual(["10.0.0.1", "10.0.0.2"], pool_recycle.call_args[1]["exclude"])
+        self.assertIsNone(pool_recycle.call_args[1]["only"])
+
+    @patch('sys.stderr')
+    @patch('sys.stdout')
+    @patch('pool_recycle.plugin.pool_recycle')
+    def test_pool_recycle_parser_with_look_ahead(self, pool_recycle, stdout, stderr):
+        plugin.pool_recycle_parser(["-p", "foobar", "--look-ahead", "2"])
+        self.assertEqual(2, pool_recycle.call_args[1]["look_ahead"])
+        self.assertRaises(SystemExit, plugin.pool_recycle_parser,
+                          ["-p", "foobar", "--look-ahead", "2", "--pre_provision"])
+
+    @patch('sys.stderr')
+    @patch('sys.stdout')
+    @patch('pool_recycle.plugin.pool_recycle')
+    def test_pool_recycle_parser_with_daemon(self, pool_recycle, stdout, stderr):
+        plugin.pool_recycle_parser(["-a", "--daemon", "--max-age", "14d"])
+        self.assertTrue(pool_recycle.call_args[1]["daemon"])
+        self.assertRaises(SystemExit, plugin.pool_recycle_parser, ["-a", "--daemon"])
+        for option in [["--dry-run"], ["--resume"], ["--pre_provision"], ["--look-ahead", "1"],
+                       ["--max-surge", "1"], ["--max-unavailable", "1"], ["--disable-old-nodes"]]:
+            self.assertRaises(SystemExit, plugin.pool_recycle_parser,
+                              ["-a", "--daemon", "--max-age", "14d"] + option)
+        self.assertEqual(pool_recycle.call_count, 1)
+
+    @patch('sys.stderr')
+    @patch('sys.stdout')
+    @patch('pool_recycle.plugin.pool_recycle')
+    def test_pool_recycle_parser_with_capacity_budget(self, pool_recycle, stdout, stderr):
+        plugin.pool_recycle_parser(["-p", "foobar", "--max-surge", "25%", "--max-unavailable", "1"])
+        self.assertEqual("25%", pool_recycle.call_args[1]["max_surge"])
+        self.assertEqual("1", pool_recycle.call_args[1]["max_unavailable"])
+        self.assertRaises(SystemExit, plugin.pool_recycle_parser, ["-p", "foobar", "--max-surge", "many"])
+        self.assertRaises(SystemExit, plugin.pool_recycle_parser,
+                          ["-p", "foobar", "--max-surge", "2", "--pre_provision"])
+        self.assertRaises(SystemExit, plugin.pool_recycle_parser, ["-p", "foobar", "--max-surge", "0"])
+        self.assertRaises(SystemExit, plugin.pool_recycle_parser,
+                          ["-p", "foobar", "--max-surge", "0%", "--max-unavailable", "0"])
+
+    @patch('sys.stderr')
+    @patch('sys.stdout')
+    @patch('pool_recycle.plugin.pool_recycle')
+    def test_pool_recycle_parser_with_http_pool_size(self, pool_recycle, stdout, stderr):
+        plugin.pool_recycle_parser(["-p", "foobar", "--http-pool-size", "32"])
+        self.assertEqual(32, pool_recycle.call_args[1]["http_pool_size"])
+
+    @patch('sys.stderr')
+    @patch('sys.stdout')
+    @patch('pool_recycle.plugin.pool_recycle')
+    def test_pool_recycle_parser_with_template_weights(self, pool_recycle, stdout, stderr):
+        plugin.pool_recycle_parser(["-p", "foobar", "-w", "templateA=3", "-w", "templateB=0.5"])
+        self.assertEqual({"templateA": 3, "templateB": 0.5},
+                         pool_recycle.call_args[1]["template_weights"])
+        self.assertRaises(SystemExit, plugin.pool_recycle_parser, ["-p", "foobar", "-w", "templateA"])
+
+    @patch("sys.stdout")
+    @patch('pool_recycle.plugin.TsuruPool')
+    def test_pool_recycle_parallel(self, tsuru_pool_mock, stdout):
+        fake_pool = FakeTsuruPool('foobar')
+        tsuru_pool_mock.return_value = fake_pool
+        plugin.pool_recycle('foobar', parallel=2)
+        self.assertItemsEqual(fake_pool.get_nodes(), ['1.2.3.4', '5.6.7.8', '9.10.11.12'])
+        stdout.write.assert_any_call('(3/3) Creating new node on pool "foobar" using "templateA" template\n')
+        stdout.write.assert_any_call('Done.\n')
+
+    @patch("sys.stdout")
+    @patch('pool_recycle.plugin.TsuruPool')
+    def test_pool_recycle_pre_provision(self, tsuru_pool_mock, stdout):
+        fake_pool = FakeTsuruPool('foobar')
+        fake_pool.remove_node = Mock()
+        fake_pool.remove_node.side_effect = lambda node, **kwargs: self.assertEqual(
+            6, len(fake_pool.get_nodes()))
+        tsuru_pool_mock.return_value = fake_pool
+        plugin.pool_recycle('foobar', pre_provision=True)
+        self.assertEqual(3, fake_pool.remove_node.call_count)
+        stdout.write.assert_any_call('3 node(s) pre-provisioned on pool "foobar".\n')
+
+    @patch('sys.stderr')
+    @patch('sys.stdout')
+    @patch('pool_recycle.plugin.pool_recycle')
+    def test_pool_recycle_parser_with_pre_provision(self, pool_recycle, stdout, stderr):
+        plugin.pool_recycle_parser(["-p", "foobar", "--pre_provision"])
+        self.assertTrue(pool_recycle.call_args[1]["pre_provision"])
+
+    @patch('sys.stderr')
+    @patch('sys.stdout')
+    @patch('pool_recycle.plugin.pool_recycle')
+    def test_pool_recycle_parser_with_many_pools(self, pool_recycle, stdout, stderr):
+        plugin.pool_recycle_parser(["-p", "foobar", "bilbo", "--max-in-flight", "8"])
+        self.assertEqual(['foobar', 'bilbo'], pool_recycle.call_args[0][0])
+        self.assertEqual(8, pool_recycle.call_args[1]["max_in_flight"])
+        self.assertRaises(SystemExit, plugin.pool_recycle_parser,
+                          ["-p", "foobar", "bilbo", "-j", "/tmp/recycle.journal"])
+        self.assertRaises(SystemExit, plugin.pool_recycle_parser,
+                          ["-p", "foobar", "--all-pools"])
+
+    @patch("sys.stdout")
+    @patch('tsuruclient.healings.Manager.update')
+    @patch('tsuruclient.healings.Manager.list')
+    @patch('tsuruclient.templates.Manager.list')
+    @patch('tsuruclient.nodes.Manager.list')
+    @patch('tsuruclient.users.Manager.info')
+    def test_pool_recycle_all_pools_with_global_limit(self, users, nodes, templates, healings,
+                                                      healing_update, stdout):
+        users.return_value = {"Email": "myuser"}
+        nodes.return_value = {"nodes": [{"Address": "10.0.0.{}".format(idx), "Pool": pool}
+                                        for idx, pool in enumerate(["foobar", "bilbo"] * 3)]}
+        templates.return_value = [{"Name": "t_" + pool, "Data": [{"Name": "pool", "Value": pool}]}
+                                  for pool in ["foobar", "bilbo"]]
+        healings.return_value = {}
+        in_flight = []
+        peak = []
+
+        def create_new_node(pool_handler, template, **kwargs):
+            in_flight.append(template)
+            peak.append(len(in_flight))
+            time.sleep(0.01)
+            in_flight.pop()
+            return "10.1.0.1"
+
+        with patch('pool_recycle.plugin.TsuruPool.create_new_node', create_new_node), \
+                patch('pool_recycle.plugin.TsuruPool.remove_node') as remove_node, \
+                patch('tsuruclient.healings.Manager.remove'):
+            plugin.pool_recycle(None, all_pools=True, parallel=3, max_in_flight=2)
+        self.assertEqual(6, remove_node.call_count)
+        self.assertEqual(1, nodes.call_count)
+        self.assertEqual(1, users.call_count)
+        self.assertLessEqual(max(peak), 2)
+        stdout.write.assert_any_call('Going to recycle 3 node(s) from pool "bilbo" using 1 templates.\n')
+        stdout.write.assert_any_call('Going to recycle 3 node(s) from pool "foobar" using 1 templates.\n')
+
+    @patch("sys.stderr")
+    @patch("sys.stdout")
+    @patch('pool_recycle.plugin.TsuruPool')
+    def test_pool_recycle_resume_from_journal(self, tsuru_pool_mock, stdout, stderr):
+        journal_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, journal_dir)
+        journal_path = os.path.join(journal_dir, "foobar.journal")
+        fake_pool = FakeTsuruPool('foobar', remove_node_from_pool_error=True,
+                                  raise_errors_on_call_counter=2)
+        tsuru_pool_mock.return_value = fake_pool
+        self.assertRaises(SystemExit, plugin.pool_recycle, 'foobar', journal_path=journal_path)
+        self.assertEqual(fake_pool.get_nodes(), ['10.10.1.1', '10.1.1.2', '1.2.3.4', '5.6.7.8'])
+
+        fake_pool.remove_node_from_pool_error = False
+        fake_pool.create_new_node = Mock(return_value='9.10.11.12')
+        plugin.pool_recycle('foobar', journal_path=journal_path, resume=True)
+        fake_pool.create_new_node.assert_called_once_with('templateA', max_retry=10, retry_interval=60,
+                                                          planner=ANY, on_failover=ANY)
+        self.assertEqual(fake_pool.get_nodes(), ['1.2.3.4', '5.6.7.8'])
+        stdout.write.assert_any_call('Resuming recycle of pool "foobar": 2 of 3 node(s) left.\n')
+        stdout.write.assert_any_call('(1/2) Reusing node 5.6.7.8 created on pool "foobar" '
+                                     'by a previous run\n')
+
+    def test_recycle_progress_matches_orphan_replacements(self):
+        start = {"step": "start", "cycles": [["10.0.0.1", "a"], ["10.0.0.2", "b"], ["10.0.0.3", "a"]]}
+        entries = [{"step": "create_requested", "node": "10.0.0.1"},
+                   {"step": "created", "node": "10.0.0.1", "new_node": "10.0.1.1"},
+                   {"step": "removed", "node": "10.0.0.1"},
+                   {"step": "create_requested", "node": "10.0.0.2"}]
+        progress = plugin.RecycleProgress(start, entries)
+        pool_nodes = ["10.0.0.2", "10.0.0.3", "10.0.1.1", "10.0.1.2"]
+        self.assertEqual(progress.pending_cycles(pool_nodes),
+                         [("10.0.0.2", "b", "10.0.1.2"), ("10.0.0.3", "a", None)])
+
+    @patch("sys.stdout")
+    def test_slow_start_doubles_after_batches_and_halves_on_trouble(self, stdout):
+        metrics = plugin.RecycleMetrics()
+        throttle = plugin.SlowStart(8, metrics=metrics)
+        stopped = Mock()
+        limits = []
+        for seconds in [10, 10, 10, 11, 9, 10, 10]:
+            throttle.acquire(stopped)
+            throttle.release("cycle", seconds)
+            limits.append(throttle.limit)
+        self.assertEqual(limits, [2, 2, 4, 4, 4, 4, 8])
+        metrics.increment("create", "retries")
+        throttle.acquire(stopped)
+        throttle.release("cycle", 10)
+        self.assertEqual(throttle.limit, 4)
+        throttle.acquire(stopped)
+        throttle.release("cycle", 40)
+        self.assertEqual(throttle.limit, 2)
+        throttle.acquire(stopped)
+        throttle.release("remove", 40)
+        throttle.acquire(stopped)
+        throttle.release("cycle", 10, failed=True)
+        self.assertEqual(throttle.limit, 1)
+        self.assertEqual(metrics.counter("concurrency", "raised"), 3)
+        self.assertEqual(metrics.counter("concurrency", "lowered"), 3)
+        stdout.write.assert_any_call("Concurrency lowered to 4: 1 retries.\n")
+        stdout.write.assert_any_call("Concurrency lowered to 2: cycle took 40 seconds.\n")
+
+    def test_token_bucket_reserves_tokens_in_order(self):
+        bucket = plugin.TokenBucket(2, burst=2)
+        for expected in [0, 0, 0.5, 1]:
+            self.assertAlmostEqual(bucket.acquire(), expected, places=2)
+        bucket.updated -= 2
+        for expected in [0, 0, 0.5]:
+            self.assertAlmostEqual(bucket.acquire(), expected, places=2)
+
+    def test_session_transport_waits_on_the_method_rate_limit(self):
+        read, write = Mock(), Mock()
+        read.acquire.return_value = 0
+        write.acquire.return_value = 0.01
+        metrics = plugin.RecycleMetrics()
+        transport = plugin.SessionTransport(rate_limits={"read": read, "write": write}, metrics=metrics)
+        transport.throttle("get")
+        transport.throttle("delete")
+        read.acquire.assert_called_once_with()
+        write.acquire.assert_called_once_with()
+        self.assertEqual(metrics.counter("write", "rate_limited"), 1)
+        self.assertEqual(metrics.counter("read", "rate_limited"), 0)
+        self.assertEqual(len(metrics.durations("phase", "rate_limit")), 1)
+
+    @patch("sys.stdout")
+    def test_recycle_workers_follow_slow_start_limit(self, stdout):
+        throttle = plugin.SlowStart(4)
+        running = []
+        peaks = []
+        lock = plugin.threading.Lock()
+
+        def job():
+            with lock:
+                running.append(1)
+                peaks.append((len(running), throttle.limit))
+            time.sleep(0.01)
+            with lock:
+                running.pop()
+        plugin.RecycleWorkers(4, throttle=throttle).run([job] * 12)
+        self.assertTrue(all(count <= limit for count, limit in peaks))
+        self.assertEqual(peaks[0], (1, 1))
+        self.assertEqual(throttle.limit, 4)
+
+    @patch("sys.stderr")
+    @patch("sys.stdout")
+    @patch('pool_recycle.plugin.TsuruPool')
+    def test_pool_recycle_parallel_stops_on_first_error(self, tsuru_pool_mock, stdout, stderr):
+        fake_pool = FakeTsuruPool('foobar', pre_provision_error=True)
+        fake_pool.disable_healing = Mock()
+        tsuru_pool_mock.return_value = fake_pool
+        self.assertRaises(SystemExit, plugin.pool_recycle, 'foobar', parallel=2)
+        stderr.write.assert_called_once_with('Failed: Error creating new node: '
+                                             '"error adding new node on IaaS"\n')
+        fake_pool.disable_healing.return_value.assert_called_once_with()
+        self.assertEqual(fake_pool.get_nodes(), ['127.0.0.1', '10.10.1.1', '10.1.1.2'])
 
     def tearDown(self):
         self.patcher.stop()
+        self.users_patcher.stop()
+
+
+class PoolRecycleEndToEndTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.fake = FakeTsuru(seed=0).start()
+        self.fake.add_template("template1", "bench")
+        self.fake.add_template("template2", "bench")
+        self.old_nodes = [self.fake.add_node("bench", "template{}".format(idx % 2 + 1), containers=idx)
+                          for idx in range(4)]
+        self.fake.healings["bench"] = {"Enabled": True}
+        self.tmpdir = tempfile.mkdtemp()
+        self.environ = patch.dict(os.environ, {"TSURU_TARGET": self.fake.url, "TSURU_TOKEN": "token"})
+        self.environ.start()
+
+    def tearDown(self):
+        self.environ.stop()
+        self.fake.stop()
+        shutil.rmtree(self.tmpdir)
+
+    @patch("sys.stdout")
+    def test_pool_recycle_replaces_every_node(self, stdout):
+        journal = os.path.join(self.tmpdir, "{pool}.journal")
+        plugin.pool_recycle("bench", parallel=2, retry_interval=1, journal_path=journal)
+        stdout.write.assert_any_call("Done.\n")
+        nodes = self.fake.pool_nodes("bench")
+        self.assertEqual(len(nodes), 4)
+        self.assertEqual(set(nodes) & set(self.old_nodes), set())
+        self.assertEqual(self.fake.healings["bench"], {"Enabled": True})
+        self.assertEqual(self.fake.calls[("POST", "node")], 4)
+        self.assertEqual(self.fake.calls[("DELETE", "node")], 4)
+
+    @patch("sys.stdout")
+    def test_concurrent_creations_resolve_to_their_own_nodes(self, stdout):
+        self.fake.boot_time = 0.3
+        pool_handler = plugin.TsuruPool("bench")
+        templates = ["template1", "template2", "template1"]
+        created = {}
+
+        def create(idx):
+            created[idx] = pool_handler.create_new_node(templates[idx], retry_interval=1)
+        plugin.run_concurrently([lambda idx=idx: create(idx) for idx in range(3)])
+        self.assertEqual(len(set(created.values())), 3)
+        nodes = dict((node["Address"], node["Metadata"]) for node in self.fake.nodes)
+        for idx, address in created.items():
+            self.assertEqual(nodes[address]["template"], templates[idx])
+        self.assertEqual(len(set(nodes[address]["pool-recycle-id"] for address in created.values())), 3)
+
+    @patch("sys.stdout")
+    def test_pool_recycle_disabling_old_nodes_moves_containers_once(self, stdout):
+        kept = self.fake.add_node("bench", "template1", containers=5)
+        journal = os.path.join(self.tmpdir, "{pool}.journal")
+        plugin.pool_recycle("bench", retry_interval=1, journal_path=journal, exclude=[kept],
+                            order="most-loaded", disable_old_nodes=True)
+        stdout.write.assert_any_call("Disabling 4 node(s) to be recycled.\n")
+        self.assertEqual(self.fake.moves, 6)
+        nodes = dict((node["Address"], node) for node in self.fake.nodes)
+        self.assertEqual(set(nodes) & set(self.old_nodes), set())
+        self.assertEqual(set(node["Status"] for node in nodes.values()), set(["ready"]))
+        self.assertEqual(nodes[kept]["Containers"], 5)
+
+    @patch("sys.stdout")
+    def test_pool_recycle_replays_recorded_run(self, stdout):
+        self.fake.boot_time = 0.2
+        trace = os.path.join(self.tmpdir, "recycle.trace")
+        journal = os.path.join(self.tmpdir, "{pool}.journal")
+        plugin.pool_recycle("bench", retry_interval=1, journal_path=journal, record=trace)
+        steps = [args[0] for args, _ in stdout.write.call_args_list
+                 if "node" in args[0] and not args[0].startswith(" ")]
+        calls = sum(1 for _ in open(trace))
+        self.assertEqual(calls, self.fake.call_count())
+        self.fake.stop()
+        stdout.reset_mock()
+        os.remove(os.path.join(self.tmpdir, "bench.journal"))
+        started = time.time()
+        plugin.pool_recycle("bench", retry_interval=1, journal_path=journal, replay=trace,
+                            replay_speed=0)
+        self.assertLess(time.time() - started, 2)
+        self.assertEqual([args[0] for args, _ in stdout.write.call_args_list
+                          if "node" in args[0] and not args[0].startswith(" ")], steps)
+        stdout.write.assert_any_call("Done.\n")
+        self.assertFalse(os.path.exists(os.path.join(self.tmpdir, "bench.journal")))
+
+    @patch("sys.stdout")
+    def test_daemon_leaves_nodes_of_unknown_age_alone(self, stdout):
+        daemon_class = plugin.RecycleDaemon
+
+        def daemon(*args, **kwargs):
+            instance = daemon_class(*args, **kwargs)
+            instance.run = lambda: daemon_class.run(instance, evaluations=1)
+            return instance
+        with patch("pool_recycle.plugin.RecycleDaemon", side_effect=daemon):
+            plugin.pool_recycle("bench", daemon=True, max_age=3600, interval=0.1)
+        self.assertEqual(sorted(self.fake.pool_nodes("bench")), sorted(self.old_nodes))
+        self.assertNotIn(("POST", "node"), self.fake.calls)
+
+    @patch("sys.stdout")
+    def test_daemon_recycles_stale_nodes_through_bounded_queue(self, stdout):
+        metrics = plugin.RecycleMetrics()
+        pool_handler = plugin.TsuruPool("bench", metrics=metrics)
+        # nodes of the fake have no node.create event
+        selector = plugin.NodeSelector(max_age=3600, unknown_age=True)
+        daemon = plugin.RecycleDaemon([pool_handler], selector,
+                                      interval=0.2, queue_size=2, workers=2, retry_interval=1,
+                                      metrics=metrics)
+        daemon.run(evaluations=3)
+        nodes = self.fake.pool_nodes("bench")
+        self.assertEqual(len(nodes), 4)
+        self.assertEqual(set(nodes) & set(self.old_nodes), set())
+        self.assertEqual(self.fake.healings["bench"], {"Enabled": True})
+        stdout.write.assert_any_call('Work queue full, node "{}" of pool "bench" left for later.\n'
+                                     .format(self.old_nodes[2]))
+        self.assertEqual(metrics.counter("daemon", "queued"), 4)
+        self.assertEqual(metrics.counter("daemon", "recycled"), 4)
+        self.assertEqual(metrics.gauges[("daemon", "queue_depth")], 0)
+        self.assertEqual(metrics.gauges[("daemon", "recycled_last_hour")], 4)
+
+    @patch("sys.stderr")
+    @patch("sys.stdout")
+    def test_pipeline_failure_gives_back_budget_and_stops(self, stdout, stderr):
+        self.fake.failing_templates = set(["template1", "template2"])
+        exits = []
+
+        def run():
+            try:
+                plugin.pool_recycle("bench", retry_interval=1, max_retry=0, look_ahead=1,
+                                    max_in_flight=1,
+                                    journal_path=os.path.join(self.tmpdir, "{pool}.journal"))
+            except SystemExit as e:
+                exits.append(e.code)
+        thread = plugin.threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        thread.join(20)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(exits, [1])
+        self.assertEqual(self.fake.healings["bench"], {"Enabled": True})
+        self.assertEqual(sorted(self.fake.pool_nodes("bench")), sorted(self.old_nodes))
+
+    @patch("sys.stderr")
+    @patch("sys.stdout")
+    def test_pool_recycle_leaves_pools_alone_when_a_later_pool_fails(self, stdout, stderr):
+        journal = os.path.join(self.tmpdir, "{pool}.journal")
+        with self.assertRaises(SystemExit) as exit:
+            plugin.pool_recycle(["bench", "empty"], retry_interval=1, journal_path=journal)
+        self.assertEqual(exit.exception.code, 1)
+        stderr.write.assert_any_call('Failed: Pool "empty" does not contain any template associate\n')
+        self.assertEqual(self.fake.healings["bench"], {"Enabled": True})
+        self.assertFalse(os.path.exists(os.path.join(self.tmpdir, "bench.journal")))
+        self.assertEqual(sorted(self.fake.pool_nodes("bench")), sorted(self.old_nodes))
+
+    @patch("sys.stderr")
+    @patch("sys.stdout")
+    def test_pool_recycle_enables_healing_when_disabling_nodes_fails(self, stdout, stderr):
+        update_node = self.fake._update_node
+        broken = self.old_nodes[2]
+
+        def fail_on_broken(params):
+            if params.get("Address") == broken and params.get("Disable") == "true":
+                return 500, "node is busy"
+            return update_node(params)
+        self.fake._update_node = fail_on_broken
+        journal = os.path.join(self.tmpdir, "{pool}.journal")
+        with self.assertRaises(SystemExit) as exit:
+            plugin.pool_recycle("bench", retry_interval=1, journal_path=journal,
+                                disable_old_nodes=True)
+        self.assertEqual(exit.exception.code, 1)
+        self.assertEqual(self.fake.healings["bench"], {"Enabled": True})
+        self.assertEqual(set(node["Status"] for node in self.fake.nodes), set(["ready"]))
+        self.assertFalse(os.path.exists(os.path.join(self.tmpdir, "bench.journal")))
+
+    @patch("sys.stdout")
+    def test_max_age_reads_ages_beyond_the_event_page(self, stdout):
+        young = self.fake.add_node("bench", "template1")
+        self.fake.add_event("node.create", young)
+        for idx in range(self.fake.event_limit):
+            self.fake.add_event("node.create", "http://10.99.{}.1:2375".format(idx))
+        plugin.pool_recycle("bench", True, max_age=3600)
+        stdout.write.assert_any_call('Selected 4 of 5 node(s) on pool "bench".\n')
+
+    def test_node_ages_are_kept_until_the_node_leaves_the_pool(self):
+        pool_handler = plugin.TsuruPool("bench")
+        pool_handler.snapshot.ttl = 0
+        young = self.fake.add_node("bench", "template1")
+        self.fake.add_event("node.create", young)
+        ages = pool_handler.get_node_ages()
+        self.assertIsNone(ages[self.old_nodes[0]])
+        self.assertLess(ages[young], 60)
+        queries = self.fake.calls[("GET", "events")]
+        self.assertEqual(queries, 5)
+        self.assertEqual(set(pool_handler.get_node_ages()), set(self.old_nodes + [young]))
+        self.assertEqual(self.fake.calls[("GET", "events")], queries)
+        self.fake.nodes = [node for node in self.fake.nodes if node["Address"] != young]
+        pool_handler.get_nodes()
+        self.assertNotIn(young, pool_handler.snapshot._created)
+        self.assertEqual(len(pool_handler.snapshot._created), 4)
+
+    @patch("sys.stdout")
+    def test_pool_recycle_with_max_age_skips_recycled_nodes(self, stdout):
+        journal = os.path.join(self.tmpdir, "{pool}.journal")
+        plugin.pool_recycle("bench", parallel=2, retry_interval=1, journal_path=journal,
+                            only=self.old_nodes[:2])
+        nodes = self.fake.pool_nodes("bench")
+        plugin.pool_recycle("bench", parallel=2, retry_interval=1, journal_path=journal,
+                            max_age=3600)
+        stdout.write.assert_any_call('Selected 2 of 4 node(s) on pool "bench".\n')
+        self.assertEqual(set(self.fake.pool_nodes("bench")) & set(nodes), set(nodes[2:]))
+        self.assertEqual(self.fake.calls[("POST", "node")], 4)
+
+    @patch("sys.stdout")
+    def test_pool_recycle_pipeline_keeps_pool_capacity(self, stdout):
+        self.fake.boot_time = 0.3
+        self.fake.remove_time = 0.3
+        counts = []
+        done = plugin.threading.Event()
+
+        def watch():
+            while not done.is_set():
+                counts.append(len(self.fake.pool_nodes("bench")))
+                time.sleep(0.02)
+        watcher = plugin.threading.Thread(target=watch)
+        watcher.start()
+        try:
+            plugin.pool_recycle("bench", retry_interval=1, look_ahead=1,
+                                journal_path=os.path.join(self.tmpdir, "{pool}.journal"))
+        finally:
+            done.set()
+            watcher.join()
+        self.assertEqual(set(self.fake.pool_nodes("bench")) & set(self.old_nodes), set())
+        self.assertGreaterEqual(min(counts), 4)
+        self.assertLessEqual(max(counts), 6)
+        self.assertGreater(max(counts), 4)
+
+    @patch("sys.stdout")
+    def test_pool_recycle_within_capacity_budget(self, stdout):
+        self.fake.boot_time = 0.3
+        self.fake.remove_time = 0.3
+        counts = []
+        done = plugin.threading.Event()
+
+        def watch():
+            while not done.is_set():
+                counts.append(len(self.fake.pool_nodes("bench")))
+                time.sleep(0.02)
+        watcher = plugin.threading.Thread(target=watch)
+        watcher.start()
+        try:
+            plugin.pool_recycle("bench", retry_interval=1, max_surge="25%", max_unavailable="1",
+                                journal_path=os.path.join(self.tmpdir, "{pool}.journal"))
+        finally:
+            done.set()
+            watcher.join()
+        stdout.write.assert_any_call('Recycling pool "bench" with at most 1 extra and 1 missing node(s).\n')
+        self.assertEqual(set(self.fake.pool_nodes("bench")) & set(self.old_nodes), set())
+        self.assertEqual(len(self.fake.pool_nodes("bench")), 4)
+        self.assertGreaterEqual(min(counts), 3)
+        self.assertEqual(max(counts), 5)
+
+    @patch("sys.stdout")
+    def test_pool_recycle_skips_empty_pool_with_capacity_percentage(self, stdout):
+        self.fake.add_template("template3", "empty")
+        self.fake.healings["empty"] = {"Enabled": True}
+        plugin.pool_recycle(["bench", "empty"], dry_mode=True, max_surge="25%")
+        stdout.write.assert_any_call("Done.\n")
+        self.assertEqual(self.fake.healings, {"bench": {"Enabled": True}, "empty": {"Enabled": True}})
+        plugin.pool_recycle(["bench", "empty"], retry_interval=1, max_surge="25%",
+                            journal_path=os.path.join(self.tmpdir, "{pool}.journal"))
+        stdout.write.assert_any_call('Recycling pool "bench" with at most 1 extra and 0 missing node(s).\n')
+        self.assertEqual(set(self.fake.pool_nodes("bench")) & set(self.old_nodes), set())
+        self.assertEqual(len(self.fake.pool_nodes("bench")), 4)
+        self.assertEqual(self.fake.pool_nodes("empty"), [])
+        self.assertEqual(self.fake.healings, {"bench": {"Enabled": True}, "empty": {"Enabled": True}})
+
+    @patch("sys.stdout")
+    def test_pool_recycle_sizes_http_pool_for_pre_provisioning(self, stdout):
+        self.old_nodes.extend(self.fake.add_node("bench", "template1") for _ in range(8))
+        grow = plugin.SessionTransport.grow
+        sizes = []
+
+        def record_size(transport, pool_size):
+            grow(transport, pool_size)
+            sizes.append(transport.adapter._pool_maxsize)
+        with patch("pool_recycle.plugin.SessionTransport.grow", new=record_size):
+            plugin.pool_recycle("bench", retry_interval=1, pre_provision=True,
+                                journal_path=os.path.join(self.tmpdir, "{pool}.journal"))
+        self.assertEqual(sizes, [10, 14])
+        self.assertEqual(set(self.fake.pool_nodes("bench")) & set(self.old_nodes), set())
+
+    def test_session_transport_reuses_connections(self):
+        pool_handler = plugin.TsuruPool("bench", http_pool_size=2)
+        for _ in range(3):
+            pool_handler.client.templates.list()
+        self.assertEqual(self.fake.connections, 1)
+        node = self.old_nodes[2]
+        self.assertEqual(pool_handler.get_node_containers(node),
+                         [{"ID": "{}-0".format(node)}, {"ID": "{}-1".format(node)}])
+        self.assertRaises(Exception, pool_handler.get_node_containers, "http://10.9.9.9:2375")